@@ -0,0 +1,711 @@
+"""This module contains the numerical core shared by the RD estimators used in the main notebook."""
+
+import numpy as np
+import pandas as pd
+from scipy import linalg, sparse, stats
+
+
+def prepare_rdd_arrays(data, columns, cluster_var='clustervar', running_variable='dist_from_cut'):
+    """
+    Sorts a dataset by the running variable once and stores all columns needed for estimation as arrays.
+    The clusters are factorized once so that every estimate computed from the arrays can reuse the codes.
+
+    Args:
+    ------
+        data(pd.DataFrame): Dataset containing the running variable, the cluster variable and all columns.
+        columns(list): List of columns that should be stored (outcomes, regressors, cutoffs, ...).
+        cluster_var(string): Name of the column that identifies the clusters.
+        running_variable(string): Name of the column that contains the running variable.
+
+    Returns:
+    ---------
+        arrays(dict): Dictionary holding the sorted running variable ('running'), the original index ('index'),
+                      the cluster codes ('clusters'), the number of clusters ('n_clusters') and one sorted array
+                      for each column in columns.
+    """
+    running = data[running_variable].to_numpy(dtype=float)
+    order = np.argsort(running, kind='mergesort')
+    clusters, uniques = pd.factorize(data[cluster_var].to_numpy()[order])
+
+    arrays = {'running': running[order],
+              'index': data.index.to_numpy()[order],
+              'clusters': clusters,
+              'n_clusters': len(uniques)}
+    for column in columns:
+        arrays[column] = data[column].to_numpy()[order]
+
+    return arrays
+
+
+def window_slice(arrays, lower, upper, closed=True):
+    """
+    Returns the slice of the sorted arrays with lower <= running <= upper (lower < running < upper
+    if closed is False).
+    """
+    if closed:
+        start = np.searchsorted(arrays['running'], lower, side='left')
+        stop = np.searchsorted(arrays['running'], upper, side='right')
+    else:
+        start = np.searchsorted(arrays['running'], lower, side='right')
+        stop = np.searchsorted(arrays['running'], upper, side='left')
+
+    return slice(start, stop)
+
+
+def subset_arrays(arrays, rows):
+    """
+    Returns the arrays restricted to rows (slice, boolean mask or positions). The cluster codes are kept so
+    that the factorization can be reused.
+    """
+    return {key: (value[rows] if isinstance(value, np.ndarray) else value) for key, value in arrays.items()}
+
+
+def group_sum(codes, values, n_groups):
+    """
+    Sums the rows of values within each group using a sparse indicator matrix.
+
+    Args:
+    ------
+        codes(np.array): Integer group code of each row (0, ..., n_groups - 1).
+        values(np.array): Array of shape (n,) or (n, m) that should be summed.
+        n_groups(int): Number of groups.
+
+    Returns:
+    ---------
+        sums(np.array): Array of shape (n_groups,) or (n_groups, m).
+    """
+    indicator = sparse.csr_matrix((np.ones(len(codes)), (codes, np.arange(len(codes)))),
+                                  shape=(n_groups, len(codes)))
+
+    return indicator @ values
+
+
+def cluster_ols(X, Y, clusters, n_clusters, n_absorbed=0):
+    """
+    OLS for many outcomes at once with standard errors clustered on 'clusters'. Each outcome only uses the
+    rows where it is not missing. Standard errors and p-values are identical to the ones of statsmodels'
+    OLS with cov_type='cluster'.
+
+    Args:
+    ------
+        X(np.array): Design matrix of shape (n, k).
+        Y(np.array): Outcomes of shape (n,) or (n, m), may contain NaN.
+        clusters(np.array): Cluster codes of shape (n,).
+        n_clusters(int): Number of distinct cluster codes.
+        n_absorbed(int): Number of parameters that were partialled out of X and Y beforehand, only used for
+                         the small sample correction.
+
+    Returns:
+    ---------
+        result(dict): Dictionary with 'params', 'bse', 'pvalues' of shape (m, k), 'cov' of shape (m, k, k)
+                      and 'nobs', 'n_groups' of shape (m,).
+    """
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float).reshape(len(X), -1)
+    n, k = X.shape
+    m = Y.shape[1]
+
+    observed = ~np.isnan(Y)
+    weights = observed.astype(float)
+    Y = np.where(observed, Y, 0)
+
+    xtx = np.einsum('nj,nk,nm->mjk', X, X, weights)
+    bread = np.linalg.pinv(xtx)
+    params = np.einsum('mjk,km->mj', bread, X.T @ Y)
+    resid = (Y - X @ params.T) * weights
+
+    scores = group_sum(clusters, (X[:, :, None] * resid[:, None, :]).reshape(n, k * m), n_clusters)
+    scores = scores.reshape(n_clusters, k, m)
+    meat = np.einsum('gjm,glm->mjl', scores, scores)
+
+    nobs = weights.sum(axis=0)
+    n_groups = (group_sum(clusters, weights, n_clusters) > 0).sum(axis=0)
+    cov = bread @ meat @ bread
+
+    return _cluster_inference(params, cov, nobs, n_groups, k + n_absorbed)
+
+
+def grouped_cluster_ols(X, y, cells, n_cells, clusters, n_clusters):
+    """
+    OLS for ONE outcome in many disjoint cells at once with standard errors clustered on 'clusters'. All cells
+    share the design matrix and the cluster codes, only the cross-products are summed per cell.
+
+    Args:
+    ------
+        X(np.array): Design matrix of shape (n, k).
+        y(np.array): Outcome of shape (n,), may contain NaN.
+        cells(np.array): Cell code of each row (0, ..., n_cells - 1).
+        n_cells(int): Number of cells.
+        clusters(np.array): Cluster codes of shape (n,).
+        n_clusters(int): Number of distinct cluster codes.
+
+    Returns:
+    ---------
+        result(dict): Same keys as cluster_ols with one row per cell.
+    """
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float)
+    observed = ~np.isnan(y)
+    X, y, cells, clusters = X[observed], y[observed], cells[observed], clusters[observed]
+    n, k = X.shape
+
+    outer = (X[:, :, None] * X[:, None, :]).reshape(n, k * k)
+    xtx = group_sum(cells, outer, n_cells).reshape(n_cells, k, k)
+    bread = np.linalg.pinv(xtx)
+    params = np.einsum('cjk,ck->cj', bread, group_sum(cells, X * y[:, None], n_cells))
+    resid = y - np.einsum('nk,nk->n', X, params[cells])
+
+    # Scores are summed within each (cell, cluster) pair that occurs in the data.
+    pairs, pair_values = pd.factorize(cells.astype(np.int64) * n_clusters + clusters)
+    pair_cells = pair_values // n_clusters
+    scores = group_sum(pairs, X * resid[:, None], len(pair_values))
+    meat = group_sum(pair_cells, (scores[:, :, None] * scores[:, None, :]).reshape(-1, k * k), n_cells)
+    cov = bread @ meat.reshape(n_cells, k, k) @ bread
+
+    nobs = np.bincount(cells, minlength=n_cells).astype(float)
+    n_groups = np.bincount(pair_cells, minlength=n_cells)
+
+    return _cluster_inference(params, cov, nobs, n_groups, k)
+
+
+def absorb_fixed_effects(values, fe_codes, tol=1e-10, max_iter=10000):
+    """
+    Removes the means within the levels of one or more fixed effects from each column of values without
+    building dummy matrices. Several fixed effects are absorbed by alternating projections.
+
+    Args:
+    ------
+        values(np.array): Array of shape (n, m).
+        fe_codes(list): List of integer code arrays of shape (n,), one for each fixed effect.
+        tol(float): Convergence criterion for the alternating projections.
+        max_iter(int): Maximum number of iterations.
+
+    Returns:
+    ---------
+        demeaned(np.array): Array of shape (n, m) that is orthogonal to all fixed effects.
+    """
+    demeaned = np.array(values, dtype=float)
+    counts = [np.bincount(codes) for codes in fe_codes]
+    for _ in range(max_iter if len(fe_codes) > 1 else 1):
+        change = 0
+        for codes, count in zip(fe_codes, counts):
+            means = group_sum(codes, demeaned, len(count)) / count[:, None]
+            demeaned = demeaned - means[codes]
+            change = max(change, np.abs(means).max())
+        if change < tol:
+            break
+
+    return demeaned
+
+
+def partial_out(X, Y, controls=None, fe_codes=None):
+    """
+    Partials controls and fixed effects out of the regressors and outcomes (Frisch-Waugh-Lovell). The means
+    are added back, so a constant in X keeps its meaning as the intercept at the average controls.
+
+    Args:
+    ------
+        X(np.array): Design matrix of shape (n, k).
+        Y(np.array): Outcomes of shape (n, m).
+        controls(np.array): Control variables of shape (n, c), optional.
+        fe_codes(list): List of integer code arrays of shape (n,), one for each fixed effect, optional.
+
+    Returns:
+    ---------
+        X_tilde(np.array): Partialled out design matrix.
+        Y_tilde(np.array): Partialled out outcomes.
+        n_absorbed(int): Number of parameters that were partialled out.
+    """
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float).reshape(len(X), -1)
+    controls = np.empty((len(X), 0)) if controls is None else np.asarray(controls, dtype=float)
+    fe_codes = [] if fe_codes is None else fe_codes
+
+    if controls.shape[1] == 0 and not fe_codes:
+        return X, Y, 0
+
+    stacked = np.column_stack([X, Y, controls])
+    means = stacked.mean(axis=0)
+    if fe_codes:
+        stacked = absorb_fixed_effects(stacked, fe_codes)
+    else:
+        stacked = stacked - means
+
+    k, m = X.shape[1], Y.shape[1]
+    if controls.shape[1] > 0:
+        gamma = np.linalg.lstsq(stacked[:, k + m:], stacked[:, :k + m], rcond=None)[0]
+        stacked = stacked[:, :k + m] - stacked[:, k + m:] @ gamma
+    stacked = stacked[:, :k + m] + means[:k + m]
+
+    n_absorbed = controls.shape[1] + sum(len(np.unique(codes)) - 1 for codes in fe_codes)
+
+    return stacked[:, :k], stacked[:, k:], n_absorbed
+
+
+def covariate_adjusted_ols(data, outcome, regressors, controls=None, fixed_effects=None, cluster_var='clustervar'):
+    """
+    Regression of ONE outcome on the regressors with standard errors clustered on cluster_var, adjusted for
+    controls and fixed effects by partialling them out. Coefficients and standard errors of the regressors
+    are the same as with the dense regression that includes the controls and one dummy per fixed effect
+    level, the constant is the intercept at the average controls.
+
+    Args:
+    ------
+        data(pd.DataFrame): Dataset containing all variables.
+        outcome(string): Name of outcome variable.
+        regressors(list): List of all regressors (must include 'const').
+        controls(list): List of control variables, optional.
+        fixed_effects(list): List of categorical variables (e.g. campus, cohort) that enter as fixed effects.
+        cluster_var(string): Name of the column that identifies the clusters.
+
+    Returns:
+    ---------
+        result(dict): Dictionary as returned by cluster_ols, plus the partialled out 'X' and 'y' and the cluster
+                      codes 'clusters' of the rows that were used.
+    """
+    controls = [] if controls is None else list(controls)
+    fixed_effects = [] if fixed_effects is None else list(fixed_effects)
+    data = data.dropna(subset=[outcome] + controls + fixed_effects)
+
+    fe_codes = [pd.factorize(data[fe])[0] for fe in fixed_effects]
+    X, y, n_absorbed = partial_out(data[regressors], data[outcome], data[controls] if controls else None,
+                                   fe_codes)
+    clusters, uniques = pd.factorize(data[cluster_var])
+    result = cluster_ols(X, y, clusters, len(uniques), n_absorbed)
+    result['X'] = X
+    result['y'] = y[:, 0]
+    result['clusters'] = clusters
+
+    return result
+
+
+def cluster_2sls(Z, D, Y, clusters, n_clusters, instrument):
+    """
+    Just-identified 2SLS for many outcomes at once with standard errors clustered on 'clusters'. The design
+    Z'Z is factorized once and solves the first stage (D on Z) and the reduced forms (Y on Z) of all outcomes
+    together. The 2SLS coefficients follow from the ratio of the reduced form to the first stage.
+
+    Args:
+    ------
+        Z(np.array): Exogenous design matrix of shape (n, k) including the excluded instrument.
+        D(np.array): Endogenous treatment of shape (n,).
+        Y(np.array): Outcomes of shape (n,) or (n, m), may contain NaN.
+        clusters(np.array): Cluster codes of shape (n,).
+        n_clusters(int): Number of distinct cluster codes.
+        instrument(int): Column of Z that is the excluded instrument and is replaced by D in the second stage.
+
+    Returns:
+    ---------
+        result(dict): Same keys as cluster_ols where the coefficient of the instrument column is the effect of
+                      D, plus the 'first_stage' coefficient of the instrument for each outcome.
+    """
+    Z = np.asarray(Z, dtype=float)
+    D = np.asarray(D, dtype=float)
+    Y = np.asarray(Y, dtype=float).reshape(len(Z), -1)
+    n, k = Z.shape
+    m = Y.shape[1]
+    X = Z.copy()
+    X[:, instrument] = D
+
+    params = np.full((m, k), np.nan)
+    cov = np.full((m, k, k), np.nan)
+    first_stage = np.full(m, np.nan)
+    nobs = np.zeros(m)
+    n_groups = np.zeros(m)
+
+    # Outcomes with the same missing values share one factorization of Z'Z.
+    observed = ~np.isnan(Y) & ~np.isnan(D)[:, None]
+    patterns, pattern_codes = np.unique(observed.T, axis=0, return_inverse=True)
+    for pattern, rows in enumerate(patterns):
+        columns = np.flatnonzero(pattern_codes.ravel() == pattern)
+        Zp, Xp, Yp, clusters_p = Z[rows], X[rows], Y[rows][:, columns], clusters[rows]
+
+        factor = linalg.cho_factor(Zp.T @ Zp)
+        reduced = linalg.cho_solve(factor, Zp.T @ np.column_stack([D[rows], Yp]))
+        pi, rho = reduced[:, 0], reduced[:, 1:]
+        effect = rho[instrument] / pi[instrument]
+        beta = rho - np.outer(pi, effect)
+        beta[instrument] = effect
+
+        resid = Yp - Xp @ beta
+        scores = group_sum(clusters_p, (Zp[:, :, None] * resid[:, None, :]).reshape(len(Zp), -1), n_clusters)
+        scores = scores.reshape(n_clusters, k, len(columns))
+        meat = np.einsum('gjm,glm->mjl', scores, scores)
+        bread = np.linalg.inv(Zp.T @ Xp)
+
+        params[columns] = beta.T
+        cov[columns] = bread @ meat @ bread.T
+        first_stage[columns] = pi[instrument]
+        nobs[columns] = len(Zp)
+        n_groups[columns] = len(np.unique(clusters_p))
+
+    result = _cluster_inference(params, cov, nobs, n_groups, k)
+    result['first_stage'] = first_stage
+
+    return result
+
+
+def kernel_weights(u, kernel='uniform'):
+    """
+    Kernel weights for the scaled distances u = (x - c) / h, zero for abs(u) > 1.
+
+    Args:
+    ------
+        u(np.array): Scaled distances from the evaluation point.
+        kernel(string): 'uniform', 'triangular' or 'epanechnikov'.
+
+    Returns:
+    ---------
+        weights(np.array): Array of the same shape as u.
+    """
+    u = np.abs(u)
+    if kernel == 'uniform':
+        return (u <= 1).astype(float)
+    elif kernel == 'triangular':
+        return np.clip(1 - u, 0, None)
+    elif kernel == 'epanechnikov':
+        return 0.75 * np.clip(1 - u ** 2, 0, None)
+    raise ValueError("kernel must be 'uniform', 'triangular' or 'epanechnikov'.")
+
+
+def solve_normal_equations(gram, rhs):
+    """
+    Solves a stack of normal equations gram @ b = rhs with a batched Cholesky factorization. Systems that are
+    (numerically) singular, e.g. a window with fewer distinct values of the running variable than parameters,
+    fall back to the minimum norm solution.
+
+    Args:
+    ------
+        gram(np.array): Stack of symmetric matrices of shape (s, K, K).
+        rhs(np.array): Right hand sides of shape (s, K).
+
+    Returns:
+    ---------
+        coef(np.array): Solutions of shape (s, K).
+    """
+    K = gram.shape[-1]
+    # Jitter keeps the factorization defined for singular systems, those are solved again below.
+    scale = np.maximum(np.diagonal(gram, axis1=1, axis2=2).max(axis=1), np.finfo(float).tiny)
+    chol = np.linalg.cholesky(gram + np.eye(K) * (scale * 1e-13)[:, None, None])
+    coef = np.linalg.solve(np.swapaxes(chol, 1, 2), np.linalg.solve(chol, rhs[:, :, None]))[:, :, 0]
+
+    diagonal = np.diagonal(chol, axis1=1, axis2=2)
+    singular = diagonal.min(axis=1) < 1e-7 * diagonal.max(axis=1)
+    for idx in np.flatnonzero(singular):
+        coef[idx] = np.linalg.pinv(gram[idx]) @ rhs[idx]
+
+    return coef
+
+
+def local_polynomial_fit(running, Y, points, bandwidth, order=1, kernel='uniform', cutoff=0, frequencies=None):
+    """
+    Local polynomial regression of order p evaluated at many points. The polynomial in each window is
+    written in the centered and scaled running variable (x - point) / bandwidth, which keeps the normal
+    equations well conditioned also for narrow windows and higher orders. Only observations on the same
+    side of the cutoff as the evaluation point are used, which is what the fully interacted design
+    (const, gpalscutoff, gpaXgpalscutoff, gpaXgpagrcutoff) does for p = 1.
+
+    Args:
+    ------
+        running(np.array): Running variable of shape (n,).
+        Y(np.array): Outcomes of shape (n,) or (n, m), may contain NaN.
+        points(np.array): Points at which the regression function is evaluated.
+        bandwidth(float): Half width of the window around each point.
+        order(int): Order of the polynomial (0, ..., 4).
+        kernel(string): 'uniform', 'triangular' or 'epanechnikov'.
+        cutoff(float): Cutoff at which the regression function may jump, None to ignore it.
+        frequencies(np.array): Frequency weights of shape (n,) or (n, m), optional. Column j of Y is fitted
+                               as if row i appeared frequencies[i, j] times, e.g. bootstrap counts.
+
+    Returns:
+    ---------
+        fitted(np.array): Fitted values of shape (len(points), m), NaN if a window has no observations.
+    """
+    running = np.asarray(running, dtype=float)
+    order_idx = np.argsort(running, kind='mergesort')
+    running = running[order_idx]
+    Y = np.asarray(Y, dtype=float).reshape(len(running), -1)[order_idx]
+    observed = (~np.isnan(Y)).astype(float)
+    Y = np.where(observed > 0, Y, 0)
+    if frequencies is not None:
+        observed = observed * np.asarray(frequencies, dtype=float).reshape(len(running), -1)[order_idx]
+    points = np.asarray(points, dtype=float)
+    powers = np.arange(order + 1)
+
+    gram = np.zeros((len(points), Y.shape[1], order + 1, order + 1))
+    rhs = np.zeros((len(points), Y.shape[1], order + 1))
+    for idx, point in enumerate(points):
+        start = np.searchsorted(running, point - bandwidth, side='left')
+        stop = np.searchsorted(running, point + bandwidth, side='right')
+        u = (running[start:stop] - point) / bandwidth
+        weights = kernel_weights(u, kernel)
+        if cutoff is not None:
+            weights = weights * ((running[start:stop] < cutoff) == (point < cutoff))
+        Z = u[:, None] ** powers
+        W = weights[:, None] * observed[start:stop]
+        outer = (Z[:, :, None] * Z[:, None, :]).reshape(len(u), (order + 1) ** 2)
+        gram[idx] = (outer.T @ W).T.reshape(-1, order + 1, order + 1)
+        rhs[idx] = (Z.T @ (W * Y[start:stop])).T
+
+    coef = solve_normal_equations(gram.reshape(-1, order + 1, order + 1), rhs.reshape(-1, order + 1))
+    fitted = coef[:, 0].reshape(len(points), Y.shape[1])
+    fitted[gram[:, :, 0, 0] == 0] = np.nan
+
+    return fitted
+
+
+def local_polynomial_rd(running, Y, clusters, n_clusters, bandwidth, order=1, kernel='uniform', cutoff=0):
+    """
+    Local polynomial RD estimate at the cutoff with standard errors clustered on 'clusters'. Both sides are
+    fitted jointly with separate polynomials of order p in (x - cutoff) / bandwidth. For p = 1 and the
+    uniform kernel this is the regression on const, gpalscutoff, gpaXgpalscutoff and gpaXgpagrcutoff.
+
+    Args:
+    ------
+        running(np.array): Running variable of shape (n,).
+        Y(np.array): Outcomes of shape (n,) or (n, m), may contain NaN.
+        clusters(np.array): Cluster codes of shape (n,).
+        n_clusters(int): Number of distinct cluster codes.
+        bandwidth(float): Observations with abs(x - cutoff) <= bandwidth are used.
+        order(int): Order of the polynomial (0, ..., 4).
+        kernel(string): 'uniform', 'triangular' or 'epanechnikov'.
+        cutoff(float): Value of the cutoff.
+
+    Returns:
+    ---------
+        result(dict): Same keys as cluster_ols where the two columns of 'params' are the jump at the cutoff
+                      (below minus above, i.e. the coefficient of gpalscutoff) and the limit from above
+                      (i.e. the constant).
+    """
+    running = np.asarray(running, dtype=float)
+    Y = np.asarray(Y, dtype=float).reshape(len(running), -1)
+    u = (running - cutoff) / bandwidth
+    weights = kernel_weights(u, kernel)
+    keep = weights > 0
+    u, weights, Y, clusters = u[keep], weights[keep], Y[keep], clusters[keep]
+
+    below = (u < 0)[:, None]
+    powers = u[:, None] ** np.arange(order + 1)
+    Z = np.column_stack([below * powers, ~below * powers])
+    n, K = Z.shape
+
+    observed = ~np.isnan(Y)
+    W = weights[:, None] * observed
+    Y = np.where(observed, Y, 0)
+    gram = np.einsum('nj,nk,nm->mjk', Z, Z, W)
+    params = solve_normal_equations(gram, np.einsum('nj,nm->mj', Z, W * Y))
+    resid = (Y - Z @ params.T) * W
+
+    scores = group_sum(clusters, (Z[:, :, None] * resid[:, None, :]).reshape(n, -1), n_clusters)
+    scores = scores.reshape(n_clusters, K, -1)
+    bread = np.linalg.pinv(gram)
+    cov = bread @ np.einsum('gjm,glm->mjl', scores, scores) @ bread
+
+    # Jump (below minus above) and limit from above at the cutoff.
+    contrast = np.zeros((2, K))
+    contrast[0, 0], contrast[0, order + 1], contrast[1, order + 1] = 1, -1, 1
+    nobs = observed.sum(axis=0).astype(float)
+    n_groups = (group_sum(clusters, observed.astype(float), n_clusters) > 0).sum(axis=0)
+
+    return _cluster_inference(params @ contrast.T, contrast @ cov @ contrast.T, nobs, n_groups, K)
+
+
+def _step_length(values, steps):
+    """
+    Returns the largest step of each column that keeps values + step * steps non-negative.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.where(steps < 0, -values / steps, np.inf)
+
+    return ratios.min(axis=0)
+
+
+def quantile_regression(Z, y, quantiles, frequencies=None, start=None, tol=1e-8, max_iter=100):
+    """
+    Linear quantile regressions of y on Z at many quantiles, solved together by the Frisch-Newton interior
+    point method. Every quantile (and every set of frequency weights) is one column, each iteration solves one
+    batch of k x k systems, and columns that have converged drop out of the batch.
+
+    With starting values, e.g. the estimates of the original sample for bootstrap samples, the preprocessing of
+    Portnoy and Koenker (1997) is used: only observations close to the starting fit are kept, the others enter
+    through their sums, which is exact as long as their residuals keep their sign. Columns where some residual
+    changes its sign are solved again with twice as many observations.
+
+    Args:
+    ------
+        Z(np.array): Design matrix of shape (n, k).
+        y(np.array): Outcome of shape (n,).
+        quantiles(np.array): Quantiles of shape (m,), values may repeat.
+        frequencies(np.array): Frequency weights of shape (n,) or (n, m), optional, e.g. bootstrap counts.
+        start(np.array): Starting values of shape (m, k), optional.
+        tol(float): A column has converged when its duality gap is below tol times its objective.
+        max_iter(int): Maximum number of iterations.
+
+    Returns:
+    ---------
+        params(np.array): Coefficients of shape (m, k).
+    """
+    Z = np.asarray(Z, dtype=float)
+    y = np.asarray(y, dtype=float)
+    quantiles = np.asarray(quantiles, dtype=float)
+    n, k = Z.shape
+    F = np.ones((n, 1)) if frequencies is None else np.asarray(frequencies, dtype=float).reshape(n, -1)
+    if start is None:
+        return _interior_point(Z, y, quantiles, F, tol, max_iter)
+
+    F = np.broadcast_to(F, (n, len(quantiles)))
+    start = np.broadcast_to(start, (len(quantiles), k))
+    params = np.empty((len(quantiles), k))
+    # Columns with the same quantile and starting values share the selected observations.
+    groups, columns = np.unique(np.column_stack([quantiles, start]), axis=0, return_inverse=True)
+    for group, (tau, *coef) in enumerate(groups):
+        todo = np.flatnonzero(columns.ravel() == group)
+        ranks = np.empty(n)
+        ranks[np.argsort(y - Z @ np.asarray(coef), kind='mergesort')] = (np.arange(n) + 0.5) / n
+        band = 3 * np.sqrt(k / n)
+        while todo.size:
+            if band >= 1:
+                params[todo] = _interior_point(Z, y, np.full(len(todo), tau), F[:, todo], tol, max_iter)
+                break
+            keep = np.abs(ranks - tau) <= band
+            above, below = ranks > tau + band, ranks < tau - band
+            # The observations above (below) the band enter through the sums of their frequency weighted
+            # rows, represented by the rows +-e_d with outcome +-bound, whose residuals keep their sign.
+            bound = 2 * np.abs(y).max() + 2 * np.abs(coef).max() + 1
+            sums = np.concatenate([F[above][:, todo].T @ Z[above], F[below][:, todo].T @ Z[below]], axis=1)
+            pseudo_F = np.concatenate([np.maximum(sums, 0), np.maximum(-sums, 0)], axis=1).T
+            pseudo_Z = np.concatenate([np.eye(k), np.eye(k), -np.eye(k), -np.eye(k)])
+            pseudo_y = np.repeat([bound, -bound, bound, -bound], k)
+            fit = _interior_point(np.concatenate([Z[keep], pseudo_Z]), np.concatenate([y[keep], pseudo_y]),
+                                  np.full(len(todo), tau), np.concatenate([F[keep][:, todo], pseudo_F]), tol,
+                                  max_iter)
+
+            resid = y[:, None] - Z @ fit.T
+            wrong = (np.any((resid[above] < 0) & (F[above][:, todo] > 0), axis=0) |
+                     np.any((resid[below] > 0) & (F[below][:, todo] > 0), axis=0) |
+                     (np.abs(fit).max(axis=1) >= bound))
+            params[todo[~wrong]] = fit[~wrong]
+            todo = todo[wrong]
+            band = 2 * band
+
+    return params
+
+
+def _interior_point(Z, y, quantiles, F, tol, max_iter):
+    """
+    Frisch-Newton interior point method (primal-dual with Mehrotra's corrector, as in Portnoy and Koenker (1997)
+    and quantreg's rq.fit.fnb) for the columns of F, see quantile_regression.
+    """
+    n, k = Z.shape
+    m = len(quantiles)
+    F = np.broadcast_to(F, (n, m))
+    outer = (Z[:, :, None] * Z[:, None, :]).reshape(n, -1)
+
+    # Dual problem: max y'a s.t. (FZ)'a = (1 - tau) (FZ)'1, 0 <= a <= 1, with primal variables x = a, s = 1 - a,
+    # dual variables d = -params and slacks z, w >= 0 with F Z d + z - w = -F y.
+    c = -F * y[:, None]
+    x = np.broadcast_to(1 - quantiles, (n, m)).copy()
+    s = 1 - x
+    d = solve_normal_equations((outer.T @ F ** 2).T.reshape(-1, k, k), (Z.T @ (F * c)).T)
+    r = c - F * (Z @ d.T)
+    r = r + 0.001 * (r == 0)
+    z = np.maximum(r, 0)
+    w = z - r
+
+    params = np.empty((m, k))
+    active = np.arange(m)
+    for _ in range(max_iter):
+        gap = np.sum(x * z + s * w, axis=0)
+        converged = gap <= tol * np.maximum(np.abs(np.sum(c * x, axis=0)), 1)
+        params[active[converged]] = -d[converged]
+        keep = ~converged
+        active, F, c, x, s, z, w, d = (active[keep], F[:, keep], c[:, keep], x[:, keep], s[:, keep],
+                                       z[:, keep], w[:, keep], d[keep])
+        if active.size == 0:
+            break
+        q = 1 / (z / x + w / s)
+        r = z - w
+        gram = (outer.T @ (F ** 2 * q)).T.reshape(-1, k, k)
+
+        # Affine scaling (predictor) direction.
+        dd = solve_normal_equations(gram, (Z.T @ (F * q * r)).T)
+        dx = q * (F * (Z @ dd.T) - r)
+        dz = -z * (dx / x + 1)
+        dw = -w * (1 - dx / s)
+        fp = np.minimum(0.99995 * np.minimum(_step_length(x, dx), _step_length(s, -dx)), 1)
+        fd = np.minimum(0.99995 * np.minimum(_step_length(z, dz), _step_length(w, dw)), 1)
+
+        # Corrector direction, centered on sigma * mu with sigma = (mu_affine / mu) ** 3.
+        mu = np.sum(x * z + s * w, axis=0)
+        mu_affine = np.sum((x + fp * dx) * (z + fd * dz) + (s - fp * dx) * (w + fd * dw), axis=0)
+        mu = mu * (mu_affine / mu) ** 3 / (2 * n)
+        xz, sw = mu - dx * dz, mu + dx * dw
+        v = xz / x - sw / s
+        dd = solve_normal_equations(gram, (Z.T @ (F * q * (r - v))).T)
+        dx = q * (F * (Z @ dd.T) + v - r)
+        dz = (xz - z * dx) / x - z
+        dw = (sw + w * dx) / s - w
+        fp = np.minimum(0.99995 * np.minimum(_step_length(x, dx), _step_length(s, -dx)), 1)
+        fd = np.minimum(0.99995 * np.minimum(_step_length(z, dz), _step_length(w, dw)), 1)
+
+        x, s = x + fp * dx, s - fp * dx
+        d = d + fd[:, None] * dd
+        z, w = z + fd * dz, w + fd * dw
+    params[active] = -d
+
+    return params
+
+
+def local_quantile_rd(running, y, quantiles, bandwidth, cutoff=0, frequencies=None, start=None):
+    """
+    Quantile RD estimates at many quantiles: on each side of the cutoff a linear quantile regression in
+    (x - cutoff) / bandwidth is fitted to the observations with abs(x - cutoff) <= bandwidth, and the jump is
+    the difference of the two intercepts.
+
+    Args:
+    ------
+        running(np.array): Running variable of shape (n,).
+        y(np.array): Outcome of shape (n,), may contain NaN.
+        quantiles(np.array): Quantiles of shape (m,).
+        bandwidth(float): Bandwidth around the cutoff.
+        cutoff(float): Value of the cutoff.
+        frequencies(np.array): Frequency weights of shape (n,) or (n, m), optional.
+        start(dict): Starting values 'below' and 'above' of shape (m, 2), e.g. the result of the original sample.
+
+    Returns:
+    ---------
+        result(dict): Dictionary with 'params' of shape (m, 2) holding the jump (below minus above) and the
+                      limit from above, the coefficients of both sides 'below' and 'above' and 'nobs'.
+    """
+    running = np.asarray(running, dtype=float)
+    y = np.asarray(y, dtype=float)
+    u = (running - cutoff) / bandwidth
+    keep = (np.abs(u) <= 1) & ~np.isnan(y)
+    if frequencies is not None:
+        frequencies = np.asarray(frequencies, dtype=float).reshape(len(running), -1)
+
+    result = {}
+    for side, rows in (('below', keep & (u < 0)), ('above', keep & (u >= 0))):
+        result[side] = quantile_regression(np.column_stack([np.ones(rows.sum()), u[rows]]), y[rows], quantiles,
+                                           None if frequencies is None else frequencies[rows],
+                                           None if start is None else start[side])
+
+    result['params'] = np.column_stack([result['below'][:, 0] - result['above'][:, 0], result['above'][:, 0]])
+    result['nobs'] = keep.sum()
+
+    return result
+
+
+def _cluster_inference(params, cov, nobs, n_groups, k):
+    """
+    Applies statsmodels' small sample correction to clustered covariance matrices and computes standard
+    errors and (normal) p-values.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correction = (n_groups / (n_groups - 1.)) * ((nobs - 1.) / (nobs - k))
+        cov = cov * correction[:, None, None]
+        bse = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+        pvalues = 2 * stats.norm.sf(np.abs(params / bse))
+
+    return {'params': params, 'bse': bse, 'pvalues': pvalues, 'cov': cov,
+            'nobs': nobs, 'n_groups': n_groups}
@@ -0,0 +1,288 @@
+"""This module contains auxiliary functions for resampling based inference used in the main notebook."""
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from auxiliary.auxiliary_estimation import *
+
+
+def draw_wild_weights(n_boot, n_clusters, weights='rademacher', seed=None):
+    """
+    Draws one weight per cluster and bootstrap replication.
+
+    Args:
+    ------
+        n_boot(int): Number of bootstrap replications.
+        n_clusters(int): Number of clusters.
+        weights(string): 'rademacher' (+1/-1) or 'webb' (six point distribution of Webb (2014)).
+        seed(int): Seed of the random number generator.
+
+    Returns:
+    ---------
+        V(np.array): Weights of shape (n_boot, n_clusters).
+    """
+    rng = np.random.default_rng(seed)
+    if weights == 'rademacher':
+        points = np.array([-1., 1.])
+    elif weights == 'webb':
+        points = np.sqrt([1.5, 1., 0.5])
+        points = np.concatenate([-points, points])
+    else:
+        raise ValueError("weights must be 'rademacher' or 'webb'.")
+
+    return rng.choice(points, size=(n_boot, n_clusters))
+
+
+def wild_cluster_bootstrap(X, y, clusters, param, n_boot=9999, weights='rademacher', restricted=True,
+                           seed=None):
+    """
+    Wild cluster bootstrap of the clustered t-statistic for H0: coefficient of column 'param' equals zero.
+    The per-cluster scores and cross-products are computed once, afterwards all bootstrap t-statistics
+    follow from one (n_boot x G) times (G x G) matrix product, so no bootstrap sample is ever refitted.
+
+    Args:
+    ------
+        X(np.array): Design matrix of shape (n, k).
+        y(np.array): Outcome of shape (n,), may contain NaN.
+        clusters(np.array): Cluster identifiers of shape (n,).
+        param(int): Column of X that is tested.
+        n_boot(int): Number of bootstrap replications.
+        weights(string): 'rademacher' or 'webb'.
+        restricted(bool): Whether the bootstrap samples are generated under the null (WCR) or not (WCU).
+        seed(int): Seed of the random number generator.
+
+    Returns:
+    ---------
+        result(dict): Dictionary with the original clustered 't-stat', the bootstrap 'p-value' and the
+                      bootstrapped t-statistics 'bootstrap t-stats'.
+    """
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float)
+    observed = ~np.isnan(y)
+    X, y = X[observed], y[observed]
+    clusters, uniques = pd.factorize(np.asarray(clusters)[observed])
+    n, k = X.shape
+    G = len(uniques)
+
+    A = np.linalg.pinv(X.T @ X)
+    beta = A @ X.T @ y
+    resid = y - X @ beta
+    w = A[param]
+
+    # Clustered t-statistic of the original sample.
+    scores = group_sum(clusters, X * resid[:, None], G)
+    correction = (G / (G - 1.)) * ((n - 1.) / (n - k))
+    t_stat = beta[param] / np.sqrt(correction * np.sum((scores @ w) ** 2))
+
+    # Residuals that are multiplied by the cluster weights.
+    if restricted:
+        keep = np.arange(k) != param
+        beta_r = np.linalg.lstsq(X[:, keep], y, rcond=None)[0]
+        boot_resid = y - X[:, keep] @ beta_r
+    else:
+        boot_resid = resid
+
+    # Per-cluster blocks: S_g = X_g'u_g and H_g = X_g'X_g. For weights v the numerator of the bootstrap
+    # t-statistic is v'a and the score of cluster h for the tested coefficient is (v'K)_h.
+    S = group_sum(clusters, X * boot_resid[:, None], G)
+    H = group_sum(clusters, (X[:, :, None] * X[:, None, :]).reshape(n, k * k), G).reshape(G, k, k)
+    a = S @ w
+    K = np.diag(a) - (S @ A) @ (H @ w).T
+
+    V = draw_wild_weights(n_boot, G, weights, seed)
+    boot_t = (V @ a) / np.sqrt(correction * np.sum((V @ K) ** 2, axis=1))
+
+    return {'t-stat': t_stat,
+            'p-value': np.mean(np.abs(boot_t) >= np.abs(t_stat)),
+            'bootstrap t-stats': boot_t}
+
+
+def leave_one_cluster_out(X, y, cells, n_cells, clusters, n_clusters):
+    """
+    Computes the coefficients without each cluster for many disjoint cells (e.g. stacked subgroups) from a
+    single fit. Dropping cluster g subtracts the block X_g'X_g from X'X, and the change of the coefficients
+    solves (X'X - X_g'X_g) (b - b_(-g)) = X_g'e_g. Each of these k x k systems is factorized on its own
+    (the factorization of X'X is not updated), all of them in one batch.
+
+    Args:
+    ------
+        X(np.array): Design matrix of shape (n, k).
+        y(np.array): Outcome of shape (n,), may contain NaN.
+        cells(np.array): Cell code of each row (0, ..., n_cells - 1).
+        n_cells(int): Number of cells.
+        clusters(np.array): Cluster codes of shape (n,).
+        n_clusters(int): Number of distinct cluster codes.
+
+    Returns:
+    ---------
+        result(dict): Dictionary with the full sample coefficients 'params' of shape (n_cells, k), the changes
+                      'delta' = b - b_(-g) of shape (P, k) for each of the P (cell, cluster) pairs, and the
+                      'cells' and 'clusters' of each pair.
+    """
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float)
+    observed = ~np.isnan(y)
+    X, y, cells, clusters = X[observed], y[observed], cells[observed], clusters[observed]
+    n, k = X.shape
+
+    outer = (X[:, :, None] * X[:, None, :]).reshape(n, k * k)
+    xtx = group_sum(cells, outer, n_cells).reshape(n_cells, k, k)
+    params = solve_normal_equations(xtx, group_sum(cells, X * y[:, None], n_cells))
+    resid = y - np.einsum('nk,nk->n', X, params[cells])
+
+    pairs, pair_values = pd.factorize(cells.astype(np.int64) * n_clusters + clusters)
+    pair_cells = pair_values // n_clusters
+    H = group_sum(pairs, outer, len(pair_values)).reshape(-1, k, k)
+    S = group_sum(pairs, X * resid[:, None], len(pair_values))
+    delta = solve_normal_equations(xtx[pair_cells] - H, S)
+
+    return {'params': params, 'delta': delta, 'cells': pair_cells, 'clusters': pair_values % n_clusters}
+
+
+def _jackknife_datasets(dictionary, keys, outcome, regressors, cluster_var):
+    """
+    Stacks the datasets of a groups dict and runs leave_one_cluster_out for all of them at once.
+    """
+    data = pd.concat([dictionary[key] for key in keys])
+    cells = np.repeat(np.arange(len(keys)), [len(dictionary[key]) for key in keys])
+    clusters, uniques = pd.factorize(data[cluster_var])
+    result = leave_one_cluster_out(data[regressors], data[outcome], cells, len(keys), clusters, len(uniques))
+    result['labels'] = uniques
+
+    return result
+
+
+def _jackknife_cv3(dictionary, keys, outcome, regressors, cluster_var, param):
+    """
+    Runs the jackknife of the datasets and returns it with the leave-one-out changes of the coefficient of param
+    and its CV3 standard error, (G - 1) / G times the sum of squared leave-one-out deviations, per dataset.
+    """
+    result = _jackknife_datasets(dictionary, keys, outcome, regressors, cluster_var)
+    idx = regressors.index(param)
+    result['estimate'] = result['params'][:, idx]
+    result['change'] = result['delta'][:, idx]
+    result['n_groups'] = np.bincount(result['cells'], minlength=len(keys))
+    result['cv3'] = np.sqrt((result['n_groups'] - 1) / result['n_groups'] *
+                            np.bincount(result['cells'], result['change'] ** 2, minlength=len(keys)))
+
+    return result
+
+
+def jackknife_RDD_multiple_datasets(dictionary, keys, outcome, regressors, cluster_var='clustervar',
+                                    param='gpalscutoff'):
+    """ Leave-one-cluster-out jackknife for ONE outcome with dictionary of MANY dataframes as input. All
+    leave-one-out estimates of all datasets come from one fit per dataset.
+
+    Args:
+    ------
+    dictionary(pd.dict): Dictionary containing datasets (datasets must contain cluster_var & the regressors)
+    keys(list): List of keys of the datasets that should be used.
+    outcome(string): Name of outcome variable (must correspond to column name in datasets)
+    regressors(list): List of all regressors (must correspond to column names in datasets)
+    cluster_var(string): Variable whose clusters are left out, e.g. 'clustervar' or a cohort variable.
+    param(string): Regressor whose coefficient is reported.
+
+    Returns:
+    ----------
+    table(pd.DataFrame): Dataframe containing the coefficient, its CV3 jackknife standard error and pvalue,
+                         the range of the leave-one-out estimates and the number of clusters.
+    """
+    result = _jackknife_cv3(dictionary, keys, outcome, regressors, cluster_var, param)
+    estimates = result['estimate'][result['cells']] - result['change']
+
+    table = pd.DataFrame(index=pd.Index(keys, name='groups'))
+    table['Estimate (1)'] = result['estimate']
+    table['Std.err CV3 (1)'] = result['cv3']
+    table['P-Value CV3 (1)'] = 2 * stats.norm.sf(np.abs(result['estimate'] / result['cv3']))
+    table['Min leave-one-out (1)'] = pd.Series(estimates).groupby(result['cells']).min().to_numpy()
+    table['Max leave-one-out (1)'] = pd.Series(estimates).groupby(result['cells']).max().to_numpy()
+    table['Clusters'] = result['n_groups']
+
+    table = table.round(3)
+
+    return table
+
+
+def cluster_influence_ranking(dictionary, keys, outcome, regressors, cluster_var='clustervar',
+                              param='gpalscutoff', top=10):
+    """
+    Ranks the clusters of each dataset by their influence on the coefficient of param.
+
+    Args:
+    ------
+        dictionary, keys, outcome, regressors, cluster_var, param: See jackknife_RDD_multiple_datasets.
+        top(int): Number of most influential clusters that are returned per dataset.
+
+    Returns:
+    ---------
+        ranking(pd.DataFrame): For each dataset the top clusters with the estimate without the cluster, the
+                               change b - b_(-g) and the change relative to the CV3 standard error (DFBETA).
+    """
+    result = _jackknife_cv3(dictionary, keys, outcome, regressors, cluster_var, param)
+
+    ranking = pd.DataFrame({'groups': np.asarray(keys, dtype=object)[result['cells']],
+                            cluster_var: result['labels'][result['clusters']],
+                            'Estimate without cluster': result['estimate'][result['cells']] - result['change'],
+                            'Change': result['change'],
+                            'DFBETA': result['change'] / result['cv3'][result['cells']]})
+    ranking['Rank'] = ranking.groupby('groups')['DFBETA'].transform(
+        lambda dfbeta: dfbeta.abs().rank(ascending=False, method='first')).astype(int)
+    ranking = ranking[ranking['Rank'] <= top].set_index(['groups', 'Rank']).sort_index()
+    ranking = ranking.reindex(keys, level='groups')
+
+    return ranking.round(3)
+
+
+def cluster_bootstrap_quantile_rd(running, y, clusters, quantiles, bandwidth, n_boot=200, seed=None, batch_size=50):
+    """
+    Quantile RD estimates (see local_quantile_rd) with standard errors from a cluster bootstrap. A bootstrap
+    sample is represented by the number of times each cluster is drawn, so all quantiles of batch_size
+    samples are fitted together, starting from the estimates of the original sample.
+
+    Args:
+    ------
+        running(np.array): Running variable of shape (n,).
+        y(np.array): Outcome of shape (n,), may contain NaN.
+        clusters(np.array): Cluster identifiers of shape (n,). Only the clusters with observations in the
+                            window are resampled.
+        quantiles(np.array): Quantiles of shape (m,).
+        bandwidth(float): Bandwidth around the cutoff.
+        n_boot(int): Number of bootstrap replications.
+        seed(int): Seed of the random number generator.
+        batch_size(int): Number of bootstrap samples that are fitted together.
+
+    Returns:
+    ---------
+        result(dict): Dictionary with 'params', 'bse' and 'pvalues' of shape (m, 2) (jump and limit from
+                      above), 'nobs' and the 'bootstrap params' of shape (n_boot, m, 2).
+    """
+    quantiles = np.asarray(quantiles, dtype=float)
+    m = len(quantiles)
+    running = np.asarray(running, dtype=float)
+    y = np.asarray(y, dtype=float)
+    sample = (np.abs(running) <= bandwidth) & ~np.isnan(y)
+    running, y = running[sample], y[sample]
+    clusters, uniques = pd.factorize(np.asarray(clusters)[sample])
+    n_clusters = len(uniques)
+
+    rng = np.random.default_rng(seed)
+    result = local_quantile_rd(running, y, quantiles, bandwidth)
+
+    boot = np.empty((n_boot, m, 2))
+    for start in range(0, n_boot, batch_size):
+        size = min(batch_size, n_boot - start)
+        draws = rng.integers(0, n_clusters, (size, n_clusters)) + n_clusters * np.arange(size)[:, None]
+        counts = np.bincount(draws.ravel(), minlength=size * n_clusters).reshape(size, n_clusters)
+        # One column per (bootstrap sample, quantile).
+        frequencies = np.repeat(counts[:, clusters].T, m, axis=1)
+        warm_start = {side: np.tile(result[side], (size, 1)) for side in ('below', 'above')}
+        fit = local_quantile_rd(running, y, np.tile(quantiles, size), bandwidth, frequencies=frequencies,
+                                start=warm_start)
+        boot[start:start + size] = fit['params'].reshape(size, m, 2)
+
+    result['bse'] = boot.std(axis=0, ddof=1)
+    result['pvalues'] = 2 * stats.norm.sf(np.abs(result['params'] / result['bse']))
+    result['bootstrap params'] = boot
+
+    return result
@@ -0,0 +1,273 @@
+"""This module contains auxiliary functions for running many RD specifications (specification curve)."""
+
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from auxiliary.auxiliary_estimation import *
+
+
+# Data shared with the worker processes, set once per process by _init_worker.
+_WORKER_DATA = {}
+
+
+def expand_specification_grid(grid):
+    """
+    Lists all specifications of a declarative grid.
+
+    Args:
+    ------
+        grid(dict): Dictionary with the keys
+                    'outcomes' (list of outcome variables),
+                    'samples' (dict of sample name: query string for data.query, None for all students),
+                    'groups' (dict of group name: dummy variable, as groups_dict_keys and groups_dict_columns),
+                    'bandwidths' (list of bandwidths),
+                    'kernels' (list of kernels, optional, default ['uniform']) and
+                    'orders' (list of polynomial orders, optional, default [1]).
+
+    Returns:
+    ---------
+        specifications(pd.DataFrame): One row per specification.
+    """
+    dimensions = ['outcome', 'sample', 'group', 'bandwidth', 'kernel', 'order']
+    specifications = itertools.product(grid['outcomes'], grid['samples'], grid['groups'], grid['bandwidths'],
+                                       grid.get('kernels', ['uniform']), grid.get('orders', [1]))
+
+    return pd.DataFrame(list(specifications), columns=dimensions)
+
+
+RESULT_COLUMNS = ['outcome', 'sample', 'group', 'bandwidth', 'kernel', 'order', 'estimate', 'std_err', 'p_value',
+                  'intercept', 'observations', 'clusters', 'key']
+
+
+def _normalize_grid(grid):
+    """
+    Returns the grid with the defaults filled in and plain Python values, so that grids built with numpy,
+    e.g. 'bandwidths': np.arange(0.1, 1.25, 0.1), can be hashed and written to the manifest.
+    """
+    return {'outcomes': [str(outcome) for outcome in grid['outcomes']],
+            'samples': {str(sample): query for sample, query in dict(grid['samples']).items()},
+            'groups': {str(group): str(column) for group, column in dict(grid['groups']).items()},
+            'bandwidths': [float(bandwidth) for bandwidth in grid['bandwidths']],
+            'kernels': [str(kernel) for kernel in grid.get('kernels', ['uniform'])],
+            'orders': [int(order) for order in grid.get('orders', [1])]}
+
+
+def _fingerprint(*arrays):
+    """
+    Returns a hash of the given arrays.
+    """
+    digest = hashlib.md5()
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+
+    return digest.hexdigest()
+
+
+def _part_path(path, part):
+    """
+    Returns the file of one part of the result store.
+    """
+    return os.path.join(path, 'part-{}.parquet'.format(part))
+
+
+def _read_index(path):
+    """
+    Reads the index of the result store, i.e. the part in which the results of each key are stored. Only parts
+    that exist are returned.
+    """
+    index = {}
+    if os.path.exists(os.path.join(path, 'index.txt')):
+        with open(os.path.join(path, 'index.txt')) as file:
+            index = dict(line.split() for line in file if line.strip())
+    existing = {part for part in set(index.values()) if os.path.exists(_part_path(path, part))}
+
+    return {key: part for key, part in index.items() if part in existing}
+
+
+def _create_tasks(grid, fingerprints):
+    """
+    Groups the specifications of a normalized grid into tasks. All specifications of one (sample, group) share
+    the row selection, the sorting and the cluster factorization, and all outcomes are estimated in the same fit.
+    The results of each (bandwidth, kernel, order) are identified by a key that hashes everything they depend on:
+    the sample and its query, the group and its dummy, the fit, the outcomes and a fingerprint of the data and
+    the sample.
+    """
+    tasks = []
+    for (sample, query), (group, column) in itertools.product(grid['samples'].items(), grid['groups'].items()):
+        fits = []
+        for bandwidth, kernel, order in itertools.product(grid['bandwidths'], grid['kernels'], grid['orders']):
+            specification = {'sample': sample, 'query': query, 'group': group, 'column': column,
+                             'bandwidth': bandwidth, 'kernel': kernel, 'order': order,
+                             'outcomes': grid['outcomes'], 'data': fingerprints[sample]}
+            key = hashlib.md5(json.dumps(specification, sort_keys=True).encode('utf-8')).hexdigest()
+            fits.append((bandwidth, kernel, order, key))
+        tasks.append({'sample': sample, 'group': group, 'fits': fits, 'outcomes': grid['outcomes']})
+
+    return tasks
+
+
+def _init_worker(data, sample_masks, group_columns):
+    """
+    Stores the data in the worker process so that it is only sent once per process.
+    """
+    _WORKER_DATA['data'] = data
+    _WORKER_DATA['sample_masks'] = sample_masks
+    _WORKER_DATA['group_columns'] = group_columns
+
+
+def _run_task(task):
+    """
+    Estimates all specifications of one task and returns their results, one row per fit and outcome.
+    """
+    data = _WORKER_DATA['data']
+    rows = _WORKER_DATA['sample_masks'][task['sample']] & \
+        (data[_WORKER_DATA['group_columns'][task['group']]] == 1).to_numpy()
+    arrays = prepare_rdd_arrays(data[rows], task['outcomes'])
+    Y = np.column_stack([arrays[outcome] for outcome in task['outcomes']]).astype(float)
+
+    results = []
+    # As in estimate_RDD_multiple_datasets only students with abs(dist_from_cut) < bandwidth are used.
+    for bandwidth, kernel, order, key in task['fits']:
+        window = window_slice(arrays, -bandwidth, bandwidth, closed=False)
+        result = local_polynomial_rd(arrays['running'][window], Y[window], arrays['clusters'][window],
+                                     arrays['n_clusters'], bandwidth, order, kernel)
+        results.append(pd.DataFrame({'outcome': task['outcomes'],
+                                     'sample': task['sample'],
+                                     'group': task['group'],
+                                     'bandwidth': bandwidth,
+                                     'kernel': kernel,
+                                     'order': order,
+                                     'estimate': result['params'][:, 0],
+                                     'std_err': result['bse'][:, 0],
+                                     'p_value': result['pvalues'][:, 0],
+                                     'intercept': result['params'][:, 1],
+                                     'observations': result['nobs'],
+                                     'clusters': result['n_groups'],
+                                     'key': key}))
+
+    return pd.concat(results, ignore_index=True)
+
+
+def _write_part(path, results):
+    """
+    Writes the results of one task to a single part and adds their keys to the index. The file is renamed into
+    place before it is indexed, so an interrupted run never leaves a partial file or an index entry without
+    results behind.
+    """
+    keys = list(dict.fromkeys(results['key']))
+    part = hashlib.md5(' '.join(keys).encode('utf-8')).hexdigest()
+    temporary = os.path.join(path, '.part-{}.parquet.tmp'.format(part))
+    results.to_parquet(temporary, index=False)
+    os.replace(temporary, _part_path(path, part))
+    with open(os.path.join(path, 'index.txt'), 'a') as file:
+        file.writelines('{} {}\n'.format(key, part) for key in keys)
+
+
+def _write_manifest(path, manifest):
+    """
+    Writes the manifest of the grid that was run last.
+    """
+    temporary = os.path.join(path, '.manifest.json.tmp')
+    with open(temporary, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(temporary, os.path.join(path, 'manifest.json'))
+
+
+def run_specification_curve(data, grid, path, processes=None):
+    """
+    Estimates all specifications of a grid and writes the results to a directory of parquet files, one per
+    sample and group. Each result carries a key that hashes everything it depends on, including the sample
+    queries and a fingerprint of the data, and an index records the part of each key. Results that already exist
+    are reused: an interrupted run can be resumed and an extended grid only estimates the new specifications.
+    A manifest records the grid, load_specification_results only returns its results.
+
+    Args:
+    ------
+        data(pd.DataFrame): Dataset prepared with prepare_data.
+        grid(dict): Declarative grid, see expand_specification_grid.
+        path(string): Directory of the result store.
+        processes(int): Number of worker processes, optional. By default the tasks run in this process.
+
+    Returns:
+    ---------
+        results(pd.DataFrame): All results of the grid, see load_specification_results.
+    """
+    os.makedirs(path, exist_ok=True)
+    grid = _normalize_grid(grid)
+
+    # Only the columns that are needed are sent to the workers, the samples are selected here.
+    group_columns = grid['groups']
+    columns = ['dist_from_cut', 'clustervar'] + grid['outcomes'] + sorted(set(group_columns.values()))
+    sample_masks = {sample: (np.ones(len(data), dtype=bool) if query is None
+                             else data.eval(query).to_numpy(dtype=bool))
+                    for sample, query in grid['samples'].items()}
+    data = data[list(dict.fromkeys(columns))].reset_index(drop=True)
+    hashed = pd.util.hash_pandas_object(data, index=False).to_numpy()
+    fingerprints = {sample: _fingerprint(hashed, mask) for sample, mask in sample_masks.items()}
+
+    tasks = _create_tasks(grid, fingerprints)
+    _write_manifest(path, {'grid': grid, 'data': _fingerprint(hashed),
+                           'keys': [key for task in tasks for *_, key in task['fits']]})
+    index = _read_index(path)
+    for task in tasks:
+        task['fits'] = [fit for fit in task['fits'] if fit[-1] not in index]
+    tasks = [task for task in tasks if task['fits']]
+
+    initargs = (data, sample_masks, group_columns)
+    if processes is None:
+        _init_worker(*initargs)
+        for task in tasks:
+            _write_part(path, _run_task(task))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(processes, initializer=_init_worker,
+                                                    initargs=initargs) as executor:
+            for future in concurrent.futures.as_completed([executor.submit(_run_task, task) for task in tasks]):
+                _write_part(path, future.result())
+
+    return load_specification_results(path)
+
+
+def load_specification_results(path, query=None, columns=None):
+    """
+    Loads the results of the grid that was run last with run_specification_curve. Results of earlier grids
+    that are still in the store are ignored, specifications that have not been estimated yet are missing.
+
+    Args:
+    ------
+        path(string): Directory of the result store.
+        query(string): Query that selects specifications, e.g. "outcome == 'nextGPA' & bandwidth < 0.5".
+        columns(list): Columns that are returned, optional. The query may use other columns.
+
+    Returns:
+    ---------
+        results(pd.DataFrame): One row per specification, sorted by estimate as in a specification curve.
+    """
+    keys, index = [], _read_index(path)
+    if os.path.exists(os.path.join(path, 'manifest.json')):
+        with open(os.path.join(path, 'manifest.json')) as file:
+            keys = [key for key in json.load(file)['keys'] if key in index]
+
+    # Only the parts of the grid are read and the keys of earlier grids are filtered out while reading.
+    if keys:
+        parts = [_part_path(path, part) for part in sorted({index[key] for key in keys})]
+        read = None if query is not None or columns is None else list(dict.fromkeys(['key', 'outcome'] + columns))
+        results = ds.dataset(parts, format='parquet').to_table(columns=read, filter=ds.field('key').isin(keys))
+        # A task that was interrupted after its part was written but before it was indexed is estimated again.
+        results = results.to_pandas().drop_duplicates(['key', 'outcome'])
+    else:
+        results = pd.DataFrame(columns=RESULT_COLUMNS)
+    if query is not None:
+        results = results.query(query)
+    if 'estimate' in results:
+        results = results.sort_values('estimate')
+    if columns is not None:
+        results = results[list(columns)]
+
+    return results.reset_index(drop=True)
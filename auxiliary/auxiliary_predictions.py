@@ -1,5 +1,6 @@
 """This module contains auxiliary functions for RD predictions used in the main notebook."""
 import json
+import os
 
 import matplotlib as plt
 import pandas as pd
@@ -9,6 +10,8 @@ import statsmodels as sm
 from auxiliary.auxiliary_predictions import *
 from auxiliary.auxiliary_plots import *
 from auxiliary.auxiliary_tables import *
+from auxiliary.auxiliary_estimation import *
+from auxiliary.auxiliary_replicates import *
 
 def prepare_data(data):
     """
@@ -81,45 +84,70 @@ def create_groups_dict(data, keys, columns):
     return groups_dict
 
 
-def create_predictions(data, outcome, regressors, bandwidth):
-    
+# Regressors of the local linear regression with separate slopes on each side of the cutoff.
+INTERACTED_REGRESSORS = ['const', 'gpalscutoff', 'gpaXgpalscutoff', 'gpaXgpagrcutoff']
+
+
+def create_predictions(data, outcome, regressors, bandwidth, controls=None, fixed_effects=None, order=1,
+                       kernel='uniform'):
+    """
+    Compute predicted outcomes from local polynomial regressions on a grid of distances from the cutoff.
+
+    Args:
+    ------
+        data(pd.DataFrame): Dataset containing 'dist_from_cut', the outcome and the regressors.
+        outcome(string): Name of outcome variable.
+        regressors(list): List of all regressors, columns of the grid such as INTERACTED_REGRESSORS or
+                          ['const', 'gpalscutoff', 'dist_from_cut'].
+        bandwidth(float): Half width of the window around each point of the grid.
+        controls(list): List of control variables that are partialled out in each window, optional.
+        fixed_effects(list): List of categorical variables that are absorbed in each window, optional.
+        order(int): Order of the local polynomial (0, ..., 4).
+        kernel(string): 'uniform', 'triangular' or 'epanechnikov'.
+
+    Returns:
+    ---------
+        predictions_df(pd.DataFrame): Dataframe containing the grid, the regressors evaluated at the grid and the
+                                      predicted outcome. With INTERACTED_REGRESSORS and without controls, the
+                                      local polynomial of the given order and kernel is fitted. Otherwise each
+                                      window is fitted by OLS on the regressors, with the prediction made at the
+                                      average controls of the window, and other orders and kernels raise a
+                                      ValueError.
+    """
+    adjusted = controls is not None or fixed_effects is not None
+    polynomial = not adjusted and sorted(regressors) == sorted(INTERACTED_REGRESSORS)
+    if not polynomial and (order != 1 or kernel != 'uniform'):
+        raise ValueError("Order and kernel can only be chosen for the regressors {} without controls or fixed "
+                         "effects.".format(INTERACTED_REGRESSORS))
+
     steps = np.arange(-1.2, 1.25, 0.05)
-    predictions_df = pd.DataFrame([])
     # Ensure there are no missings in the outcome variable.
     data = data.dropna(subset=[outcome])
+
+    predictions_df = pd.DataFrame({'dist_from_cut': steps}, index=steps)
+    predictions_df['gpalscutoff'] = (steps < 0).astype(float)
+    predictions_df['gpaXgpalscutoff'] = steps * predictions_df['gpalscutoff']
+    predictions_df['gpaXgpagrcutoff'] = steps * (1 - predictions_df['gpalscutoff'])
+    predictions_df['const'] = 1.
+
+    if polynomial:
+        predictions_df['prediction'] = local_polynomial_fit(
+            data['dist_from_cut'], data[outcome], steps, bandwidth, order, kernel)[:, 0]
+        return predictions_df
+
+    # Rows with missing controls are not used, so windows without any other rows are recognized as empty.
+    data = data.dropna(subset=(controls or []) + (fixed_effects or []))
     # Loop through bins or 'steps'.
     for step in steps:
         df = data[(data.dist_from_cut >= (step - bandwidth)) &
                   (data.dist_from_cut <= (step + bandwidth))]
-        # Run regression for with all values in the range specified above.
-        model = sm.regression.linear_model.OLS(
-            df[outcome], df[regressors], hasconst=True)
-        result = model.fit(cov_type='cluster', cov_kwds={
-                           'groups': df['clustervar']})
-
-        # Fill in row for each step in the prediction datframe.
-        predictions_df.loc[step, 'dist_from_cut'] = step
-        if step < 0:
-            predictions_df.loc[step, 'gpalscutoff'] = 1
-        else:
-            predictions_df.loc[step, 'gpalscutoff'] = 0
-
-        predictions_df.loc[step, 'gpaXgpalscutoff'] = (
-            predictions_df.loc[step, 'dist_from_cut']) * predictions_df.loc[step, 'gpalscutoff']
-        predictions_df.loc[step, 'gpaXgpagrcutoff'] = (predictions_df.loc[
-                                                       step, 'dist_from_cut']) * (1 - predictions_df.loc[step, 'gpalscutoff'])
-        predictions_df.loc[step, 'const'] = 1
-
-        # Make prediction for each step based on regression of each step and
-        # save value in the prediction dataframe.
-        predictions_df.loc[step, 'prediction'] = result.predict(exog=[[
-            predictions_df.loc[step, 'const'],
-            predictions_df.loc[step, 'gpalscutoff'],
-            predictions_df.loc[step, 'gpaXgpalscutoff'],
-            predictions_df.loc[step, 'gpaXgpagrcutoff']
-        ]])
-
-    predictions_df.round(4)
+        # As in local_polynomial_fit, there is no prediction for an empty window.
+        if df.empty:
+            predictions_df.loc[step, 'prediction'] = np.nan
+            continue
+        # Run regression for with all values in the range specified above and make prediction.
+        result = covariate_adjusted_ols(df, outcome, regressors, controls, fixed_effects)
+        predictions_df.loc[step, 'prediction'] = np.dot(result['params'][0], predictions_df.loc[step, regressors])
 
     return predictions_df
 
@@ -151,94 +179,128 @@ def create_bin_frequency_predictions(data, steps, bandwidth):
     return predictions_df
 
 
-def create_fig3_predictions(groups_dict, regressors, bandwidth):
+def create_fig3_predictions(groups_dict, regressors, bandwidth, controls=None, fixed_effects=None, order=1,
+                            kernel='uniform'):
     """
-    Compute predicted outcomes for figure 3.
+    Compute predicted outcomes for figure 3. All arguments apart from groups_dict are passed on to
+    create_predictions, so order and kernel cannot be combined with controls or fixed effects.
     """
-    
     predictions_groups_dict = {}
-    # Loop through groups:
+    # Loop through groups and save the predictions for all groups in a dictionary.
     for group in groups_dict:
-
-        steps = np.arange(-1.2, 1.25, 0.05)
-        predictions_df = pd.DataFrame([])
-
-        # Loop through bins or 'steps'.
-        for step in steps:
-            # Select dataframe from the dictionary.
-            df = groups_dict[group][(groups_dict[group].dist_from_cut >= (step - bandwidth)) &
-                                    (groups_dict[group].dist_from_cut <= (step + bandwidth))]
-            # Run regression for with all values in the range specified above.
-            model = sm.regression.linear_model.OLS(
-                df['left_school'], df[regressors], hasconst=True)
-            result = model.fit(cov_type='cluster', cov_kwds={
-                               'groups': df['clustervar']})
-
-            # Fill in row for each step in the prediction datframe.
-            predictions_df.loc[step, 'dist_from_cut'] = step
-            if step < 0:
-                predictions_df.loc[step, 'gpalscutoff'] = 1
-            else:
-                predictions_df.loc[step, 'gpalscutoff'] = 0
-
-            predictions_df.loc[step, 'gpaXgpalscutoff'] = (
-                predictions_df.loc[step, 'dist_from_cut']) * predictions_df.loc[step, 'gpalscutoff']
-            
-            predictions_df.loc[step, 'gpaXgpagrcutoff'] = (
-                predictions_df.loc[step, 'dist_from_cut']) * (1 - predictions_df.loc[step, 'gpalscutoff'])
-            predictions_df.loc[step, 'const'] = 1
-
-            # Make prediction for each step based on regression of each step
-            # and save value in the prediction dataframe.
-            predictions_df.loc[step, 'prediction'] = result.predict(exog=[[
-                predictions_df.loc[step, 'const'],
-                predictions_df.loc[step, 'gpalscutoff'],
-                predictions_df.loc[step, 'gpaXgpalscutoff'],
-                predictions_df.loc[step, 'gpaXgpagrcutoff']
-            ]])
-
-            predictions_df = predictions_df.round(4)
-            
-        # Save the predictions for all groups in a dictionary.
-        predictions_groups_dict[group] = predictions_df
+        predictions_groups_dict[group] = create_predictions(
+            groups_dict[group], 'left_school', regressors, bandwidth, controls, fixed_effects, order, kernel
+        ).round(4)
 
     return predictions_groups_dict
 
 
-def bootstrap_predictions(n, data, outcome, regressors, bandwidth):
+def _bootstrap_prediction_replicates(rng, n, running, y, steps, bandwidth, batch_size=100):
+    """
+    Draws n bootstrap samples with replacement and returns the predictions of shape (n, len(steps)). Each
+    bootstrap sample is represented by the number of times each observation is drawn, so a batch of samples
+    is fitted at once as frequency weighted columns.
+    """
+    replicates = np.empty((n, len(steps)))
+    for start in range(0, n, batch_size):
+        size = min(batch_size, n - start)
+        draws = rng.integers(0, len(running), (size, len(running)))
+        draws = draws + len(running) * np.arange(size)[:, None]
+        counts = np.bincount(draws.ravel(), minlength=size * len(running)).reshape(size, len(running))
+        replicates[start:start + size] = local_polynomial_fit(
+            running, np.broadcast_to(y[:, None], (len(y), size)), steps, bandwidth, frequencies=counts.T).T
+
+    return replicates
+
+
+def bootstrap_predictions(n, data, outcome, regressors, bandwidth, store=None, seed=None, chunk_size=1000):
     """
     Compute predicted outcome from bootstrap with replacement.
+
+    Args:
+    ------
+        n(int): Number of bootstrap replications.
+        data(pd.DataFrame): Dataset containing 'dist_from_cut' and the outcome.
+        outcome(string): Name of outcome variable.
+        regressors(list): List of all regressors. The replicates are local linear fits with separate slopes on
+                          each side of the cutoff, so only INTERACTED_REGRESSORS are supported.
+        bandwidth(float): Half width of the window around each point of the grid, see create_predictions.
+        store(string): Directory of a replicate store, optional. If specified, the replicates are written to
+                       disk in chunks of chunk_size instead of being returned, and an interrupted run
+                       continues with the missing chunks.
+        seed(int): Seed of the random number generator. With a store each chunk uses its own stream, so
+                   the replicates do not depend on which chunks were computed in which run.
+        chunk_size(int): Number of replicates per chunk of the store.
+
+    Returns:
+    ---------
+        bootstrap_pred(pd.DataFrame): One column 'pred_i' per replication, or the metadata of the store.
     """
-    bootstrap_pred = pd.DataFrame({})
-    for i in range(0, n):
-        bootstrap = data.sample(n=len(data), replace=True)
-        pred = create_predictions(
-            data=bootstrap, outcome=outcome, regressors=regressors, bandwidth=bandwidth)
-        bootstrap_pred['pred_' + str(i)] = pred.prediction
-        i = +1
-    return bootstrap_pred
+    if sorted(regressors) != sorted(INTERACTED_REGRESSORS):
+        raise ValueError("Bootstrap predictions are only available for the regressors {}.".format(
+            INTERACTED_REGRESSORS))
+
+    steps = np.arange(-1.2, 1.25, 0.05)
+    running = data['dist_from_cut'].to_numpy(dtype=float)
+    y = data[outcome].to_numpy(dtype=float)
+
+    if store is None:
+        replicates = _bootstrap_prediction_replicates(np.random.default_rng(seed), n, running, y, steps, bandwidth)
+        return pd.DataFrame(replicates.T, index=steps, columns=['pred_' + str(i) for i in range(n)])
+
+    if seed is None:
+        seed = (read_replicate_metadata(store)['seed'] if os.path.exists(os.path.join(store, 'metadata.json'))
+                else int(np.random.SeedSequence().entropy))
+    metadata = create_replicate_store(store, n, steps, {'kind': 'bootstrap predictions', 'seed': seed,
+                                                        'outcome': outcome, 'bandwidth': bandwidth,
+                                                        'regressors': list(regressors)}, chunk_size)
+    for chunk in missing_chunks(store):
+        rng = np.random.default_rng([seed, chunk])
+        replicates = _bootstrap_prediction_replicates(rng, len(chunk_rows(metadata, chunk)), running, y, steps,
+                                                      bandwidth)
+        write_replicate_chunk(store, chunk, replicates)
+
+    return metadata
 
 
 def get_confidence_interval(data, lbound, ubound, index_var):
     """
     Compute confidence interval from data of bootstrapped predictions.
+
+    Args:
+    ------
+        data(pd.DataFrame or string): Bootstrapped predictions with one row per point, or the directory of a
+                                      replicate store, whose percentiles are computed blockwise from disk.
+        lbound(float): Percentile of the lower bound.
+        ubound(float): Percentile of the upper bound.
+        index_var(string): Name of the column that holds the points.
+
+    Returns:
+    ---------
+        confidence_interval(pd.DataFrame): Lower and upper bound at each point.
     """
-    confidence_interval = pd.DataFrame({})
-    for i in data.index:
-        confidence_interval.loc[i, "lower_bound"] = np.percentile(data.loc[
-                                                                  i, :], lbound)
-        confidence_interval.loc[i, "upper_bound"] = np.percentile(data.loc[
-                                                                  i, :], ubound)
-
-    confidence_interval[index_var] = confidence_interval.index 
-    
+    if isinstance(data, str):
+        percentiles = replicate_percentiles(data, [lbound, ubound])
+    else:
+        percentiles = pd.DataFrame(np.percentile(data.to_numpy(dtype=float), [lbound, ubound], axis=1).T,
+                                   index=data.index)
+
+    confidence_interval = pd.DataFrame({'lower_bound': percentiles.iloc[:, 0].to_numpy(),
+                                        'upper_bound': percentiles.iloc[:, 1].to_numpy()},
+                                       index=percentiles.index)
+    confidence_interval[index_var] = confidence_interval.index
+
     return confidence_interval
 
+
 def bandwidth_sensitivity_summary(
-    data, outcome, groups_dict_keys, groups_dict_columns, regressors
+    data, outcome, groups_dict_keys, groups_dict_columns, regressors, n_boot=None, seed=0, weights='rademacher',
+    restricted=True
 ):
     """
-    Creates table that summarizes the results for the analysis of bandwidth sensitivity.
+    Creates table that summarizes the results for the analysis of bandwidth sensitivity. If n_boot is specified,
+    the p-values are computed from a wild cluster bootstrap (with seed, weights and restricted as in
+    estimate_RDD_multiple_datasets), which is more reliable for the narrow bandwidths with few clusters.
     """
     bandwidths = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1, 1.1, 1.2]
     arrays = [
@@ -256,7 +318,8 @@ def bandwidth_sensitivity_summary(
         groups_dict = create_groups_dict(
             sample, groups_dict_keys, groups_dict_columns)
         table = estimate_RDD_multiple_datasets(
-            groups_dict, groups_dict_keys, outcome, regressors
+            groups_dict, groups_dict_keys, outcome, regressors, n_boot=n_boot, seed=seed, weights=weights,
+            restricted=restricted
         )
         summary.loc[(val, "probation"), :] = table["GPA below cutoff (1)"]
         summary.loc[(val, "p-value"), :] = table["P-Value (1)"]
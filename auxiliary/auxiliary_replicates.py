@@ -0,0 +1,136 @@
+"""This module contains auxiliary functions for storing bootstrap and permutation replicates on disk."""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def _chunk_path(path, chunk):
+    """
+    Returns the file of one chunk of replicates.
+    """
+    return os.path.join(path, 'replicates-{:05d}.npy'.format(chunk))
+
+
+def create_replicate_store(path, n_replicates, grid, metadata=None, chunk_size=1000):
+    """
+    Creates a replicate store, i.e. a directory with a metadata.json and one float32 .npy file per chunk of
+    replicates. If the store already exists with the same metadata it is reused, so that an interrupted
+    run only has to compute the missing chunks.
+
+    Args:
+    ------
+        path(string): Directory of the store.
+        n_replicates(int): Number of replicates.
+        grid(list): Points at which each replicate is evaluated, e.g. the steps of create_predictions.
+        metadata(dict): Further information that is stored, e.g. kind, seed, outcome and bandwidth.
+        chunk_size(int): Number of replicates per chunk.
+
+    Returns:
+    ---------
+        metadata(dict): Metadata of the store.
+    """
+    metadata = dict(metadata or {}, n_replicates=int(n_replicates), chunk_size=int(chunk_size),
+                    grid=[float(point) for point in grid], dtype='float32')
+    # Round trip through json so that the comparison with an existing store is exact.
+    metadata = json.loads(json.dumps(metadata))
+
+    metadata_path = os.path.join(path, 'metadata.json')
+    if os.path.exists(metadata_path):
+        existing = read_replicate_metadata(path)
+        if existing != metadata:
+            raise ValueError("The store '{}' exists with different metadata.".format(path))
+        return existing
+
+    os.makedirs(path, exist_ok=True)
+    with open(metadata_path, 'w') as file:
+        json.dump(metadata, file, indent=1)
+
+    return metadata
+
+
+def read_replicate_metadata(path):
+    """
+    Reads the metadata of a replicate store.
+    """
+    with open(os.path.join(path, 'metadata.json')) as file:
+        return json.load(file)
+
+
+def missing_chunks(path):
+    """
+    Returns the chunks of a replicate store that have not been written yet.
+    """
+    metadata = read_replicate_metadata(path)
+    n_chunks = -(-metadata['n_replicates'] // metadata['chunk_size'])
+
+    return [chunk for chunk in range(n_chunks) if not os.path.exists(_chunk_path(path, chunk))]
+
+
+def chunk_rows(metadata, chunk):
+    """
+    Returns the replicates that belong to a chunk as a range.
+    """
+    start = chunk * metadata['chunk_size']
+
+    return range(start, min(start + metadata['chunk_size'], metadata['n_replicates']))
+
+
+def write_replicate_chunk(path, chunk, values):
+    """
+    Writes one chunk of replicates of shape (len(chunk_rows), len(grid)). The file is renamed into place
+    after it is complete, so a store never contains a partial chunk.
+    """
+    metadata = read_replicate_metadata(path)
+    shape = (len(chunk_rows(metadata, chunk)), len(metadata['grid']))
+    temporary = os.path.join(path, '.replicates-{:05d}.npy.tmp'.format(chunk))
+
+    array = np.lib.format.open_memmap(temporary, mode='w+', dtype=np.float32, shape=shape)
+    array[:] = values
+    array.flush()
+    del array
+    os.replace(temporary, _chunk_path(path, chunk))
+
+
+def open_replicate_store(path):
+    """
+    Opens all chunks of a replicate store memory-mapped.
+
+    Returns:
+    ---------
+        metadata(dict): Metadata of the store.
+        chunks(list): Read-only memory-mapped arrays of shape (replicates in chunk, len(grid)).
+    """
+    metadata = read_replicate_metadata(path)
+    if missing_chunks(path):
+        raise ValueError("The store '{}' is incomplete, chunks {} are missing.".format(path, missing_chunks(path)))
+    n_chunks = -(-metadata['n_replicates'] // metadata['chunk_size'])
+
+    return metadata, [np.load(_chunk_path(path, chunk), mmap_mode='r') for chunk in range(n_chunks)]
+
+
+def replicate_percentiles(path, percentiles, block_size=64):
+    """
+    Computes percentiles of the replicates at each point of the grid. The grid is processed in blocks of
+    block_size points, so only n_replicates x block_size values are held in memory at a time.
+
+    Args:
+    ------
+        path(string): Directory of the store.
+        percentiles(list): Percentiles between 0 and 100.
+        block_size(int): Number of grid points per block.
+
+    Returns:
+    ---------
+        table(pd.DataFrame): Percentiles (columns) at each point of the grid (index).
+    """
+    metadata, chunks = open_replicate_store(path)
+    grid = metadata['grid']
+    table = np.empty((len(grid), len(percentiles)))
+    for start in range(0, len(grid), block_size):
+        block = np.concatenate([chunk[:, start:start + block_size] for chunk in chunks])
+        table[start:start + block_size] = np.percentile(block.astype(float), percentiles, axis=0).T
+
+    return pd.DataFrame(table, index=pd.Index(grid), columns=list(percentiles))
@@ -0,0 +1,223 @@
+"""This module contains a local query service for RD estimates that keeps the prepared data in memory.
+
+Start it from the main folder with
+
+    python -m auxiliary.auxiliary_service --data data/data_for_analysis.dta --port 8050
+
+and query it with e.g.
+
+    http://127.0.0.1:8050/estimate?outcome=nextGPA&group=Male&bandwidth=0.6
+    http://127.0.0.1:8050/predictions?outcome=left_school&group=All&bandwidth=0.6
+    http://127.0.0.1:8050/bandwidths?outcome=nextGPA&group=All&bandwidths=0.1,0.2,0.3
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from auxiliary.auxiliary_estimation import *
+from auxiliary.auxiliary_predictions import prepare_data
+
+
+GROUPS_DICT_KEYS = ('All', 'HS Grades < median', 'HS Grades > median', 'Male', 'Female',
+                    'Native English', 'Nonnative English')
+GROUPS_DICT_COLUMNS = ('const', 'lowHS', 'highHS', 'male', 'female', 'english', 'noenglish')
+REGRESSORS = ('const', 'gpalscutoff', 'gpaXgpalscutoff', 'gpaXgpagrcutoff')
+
+
+def load_rdd_state(data, outcomes, groups_dict_keys=GROUPS_DICT_KEYS, groups_dict_columns=GROUPS_DICT_COLUMNS,
+                   regressors=REGRESSORS):
+    """
+    Sorts the prepared data once and stores everything the queries need: the sorted arrays, the cluster
+    factorization and one row mask per subgroup.
+
+    Args:
+    ------
+        data(pd.DataFrame): Dataset prepared with prepare_data.
+        outcomes(list): List of outcomes that can be queried.
+        groups_dict_keys(list): Names of the subgroups.
+        groups_dict_columns(list): Dummy variables that define the subgroups.
+        regressors(list): List of all regressors.
+
+    Returns:
+    ---------
+        state(dict): Dictionary holding the arrays, the design matrix, the group masks and the outcomes.
+    """
+    regressors = list(regressors)
+    arrays = prepare_rdd_arrays(data, list(outcomes) + regressors + list(set(groups_dict_columns)))
+    state = {'arrays': arrays,
+             'X': np.column_stack([arrays[regressor] for regressor in regressors]).astype(float),
+             'regressors': regressors,
+             'outcomes': list(outcomes),
+             'groups': {key: arrays[column] == 1 for key, column in zip(groups_dict_keys, groups_dict_columns)}}
+
+    return state
+
+
+def _select(state, outcome, group):
+    """
+    Checks the query and returns the outcome array and the group mask.
+    """
+    if outcome not in state['outcomes']:
+        raise ValueError("Unknown outcome '{}'.".format(outcome))
+    if group not in state['groups']:
+        raise ValueError("Unknown group '{}'.".format(group))
+
+    return state['arrays'][outcome].astype(float), state['groups'][group]
+
+
+def _check_rows(y, rows, outcome, group, bandwidth):
+    """
+    Raises an error if the selected window contains no observed outcomes.
+    """
+    if not np.any(~np.isnan(y[rows])):
+        raise ValueError("No observations of '{}' for group '{}' within bandwidth {}.".format(outcome, group,
+                                                                                            bandwidth))
+
+
+def estimate_from_state(state, outcome, group, bandwidth):
+    """
+    Estimates the discontinuity for students with abs(dist_from_cut) < bandwidth, as in
+    estimate_RDD_multiple_datasets.
+    """
+    y, mask = _select(state, outcome, group)
+    window = window_slice(state['arrays'], -bandwidth, bandwidth, closed=False)
+    rows = np.arange(window.start, window.stop)[mask[window]]
+    _check_rows(y, rows, outcome, group, bandwidth)
+    result = cluster_ols(state['X'][rows], y[rows], state['arrays']['clusters'][rows],
+                         state['arrays']['n_clusters'])
+
+    treat = state['regressors'].index('gpalscutoff')
+    const = state['regressors'].index('const')
+    return {'outcome': outcome, 'group': group, 'bandwidth': bandwidth,
+            'GPA below cutoff (1)': result['params'][0, treat],
+            'P-Value (1)': result['pvalues'][0, treat],
+            'Std.err (1)': result['bse'][0, treat],
+            'Intercept (0)': result['params'][0, const],
+            'P-Value (0)': result['pvalues'][0, const],
+            'Std.err (0)': result['bse'][0, const],
+            'Observations': result['nobs'][0]}
+
+
+def predictions_from_state(state, outcome, group, bandwidth, sample_bandwidth=1.2, order=1, kernel='uniform'):
+    """
+    Computes the predicted outcome on the grid of create_predictions for students with
+    abs(dist_from_cut) < sample_bandwidth.
+    """
+    y, mask = _select(state, outcome, group)
+    sample = window_slice(state['arrays'], -sample_bandwidth, sample_bandwidth, closed=False)
+    rows = np.arange(sample.start, sample.stop)[mask[sample]]
+    _check_rows(y, rows, outcome, group, sample_bandwidth)
+    steps = np.arange(-1.2, 1.25, 0.05)
+    fitted = local_polynomial_fit(state['arrays']['running'][rows], y[rows], steps, bandwidth, order, kernel)
+
+    return [{'dist_from_cut': round(step, 4), 'prediction': prediction}
+            for step, prediction in zip(steps, fitted[:, 0])]
+
+
+def create_query_handler(state, cache_size=1024):
+    """
+    Returns a function that answers 'estimate', 'predictions' and 'bandwidths' queries from the state and
+    keeps the last cache_size results in an LRU cache.
+    """
+    @functools.lru_cache(maxsize=cache_size)
+    def query(kind, outcome, group, bandwidths):
+        if kind == 'estimate':
+            return estimate_from_state(state, outcome, group, bandwidths[0])
+        elif kind == 'predictions':
+            return predictions_from_state(state, outcome, group, bandwidths[0])
+        elif kind == 'bandwidths':
+            return [estimate_from_state(state, outcome, group, bandwidth) for bandwidth in bandwidths]
+        raise ValueError("Unknown query '{}'.".format(kind))
+
+    return query
+
+
+def _to_json(result):
+    """
+    Converts a query result to JSON. NaN (e.g. p-values of windows with a single cluster) becomes null.
+    """
+    if isinstance(result, dict):
+        return {key: _to_json(value) for key, value in result.items()}
+    if isinstance(result, list):
+        return [_to_json(value) for value in result]
+    if isinstance(result, (float, np.number)):
+        return float(result) if np.isfinite(result) else None
+
+    return result
+
+
+def _parse_request(target):
+    """
+    Turns a request target like '/estimate?outcome=nextGPA&group=All&bandwidth=0.6' into hashable query
+    arguments.
+    """
+    url = urlsplit(target)
+    params = {key: values[0] for key, values in parse_qs(url.query).items()}
+    bandwidths = params.get('bandwidths', params.get('bandwidth', '0.6'))
+    bandwidths = tuple(round(float(value), 4) for value in bandwidths.split(','))
+    if not all(np.isfinite(bandwidths)) or min(bandwidths) <= 0:
+        raise ValueError('Bandwidths must be positive.')
+
+    return url.path.strip('/'), params.get('outcome', 'nextGPA'), params.get('group', 'All'), bandwidths
+
+
+async def _handle_connection(query, reader, writer):
+    """
+    Answers one HTTP request. The estimation runs in a worker thread so that other connections are served
+    in the meantime.
+    """
+    request_line = (await reader.readline()).decode('latin-1').split()
+    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+        pass
+
+    try:
+        arguments = _parse_request(request_line[1])
+        result = await asyncio.get_running_loop().run_in_executor(None, query, *arguments)
+        status, body = '200 OK', json.dumps(_to_json(result), allow_nan=False)
+    except (ValueError, IndexError) as error:
+        status, body = '400 Bad Request', json.dumps({'error': str(error)})
+
+    body = body.encode('utf-8')
+    writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                 'Connection: close\r\n\r\n'.format(status, len(body)).encode('latin-1') + body)
+    await writer.drain()
+    writer.close()
+
+
+async def serve_rdd_queries(state, host='127.0.0.1', port=8050, cache_size=1024):
+    """
+    Serves queries on host:port until cancelled.
+    """
+    query = create_query_handler(state, cache_size)
+    server = await asyncio.start_server(functools.partial(_handle_connection, query), host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    """
+    Loads and prepares the data once and starts the service.
+    """
+    parser = argparse.ArgumentParser(description='Local query service for RD estimates.')
+    parser.add_argument('--data', default='data/data_for_analysis.dta')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--cache-size', type=int, default=1024)
+    parser.add_argument('--outcomes', default='left_school,nextGPA,nextCGPA,probation_year1,probation_ever,'
+                                              'suspended_ever,gradin4,gradin5,gradin6,total_credits_year2,'
+                                              'nextGPA_above_cutoff,nextCGPA_above_cutoff')
+    args = parser.parse_args()
+
+    data = prepare_data(pd.read_stata(args.data))
+    state = load_rdd_state(data, args.outcomes.split(','))
+    asyncio.run(serve_rdd_queries(state, args.host, args.port, args.cache_size))
+
+
+if __name__ == '__main__':
+    main()
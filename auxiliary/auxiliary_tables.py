@@ -1,6 +1,8 @@
 """This module contains auxiliary functions for the creation of tables in the main notebook."""
 
+import functools
 import json
+import multiprocessing
 
 import matplotlib as plt
 import pandas as pd
@@ -10,6 +12,8 @@ import statsmodels as sm
 from auxiliary.auxiliary_predictions import *
 from auxiliary.auxiliary_plots import *
 from auxiliary.auxiliary_tables import *
+from auxiliary.auxiliary_estimation import *
+from auxiliary.auxiliary_inference import *
 
 
 def color_pvalues(value):
@@ -29,7 +33,8 @@ def color_pvalues(value):
     return "color: %s" % color
 
 
-def estimate_RDD_multiple_outcomes(data, outcomes, regressors):
+def estimate_RDD_multiple_outcomes(data, outcomes, regressors, n_boot=None, controls=None, fixed_effects=None,
+                                   seed=0, weights='rademacher', restricted=True):
     """ Regression analysis with standard errors clustered on GPA, on probation cutoff for multiple 
     outcomes contained in ONE dataframe.
 
@@ -38,6 +43,12 @@ def estimate_RDD_multiple_outcomes(data, outcomes, regressors):
     data(pd.DataFrame): Dataset containing all data (must contain 'clustervar', 'gpalscutoff', & 'const')
     outcomes(list): List of all outcomes (must correspond to column names in dataset)
     regressors(list): List of all regressors (must correspond to column names in dataset)
+    n_boot(int): If specified, p-values are computed from a wild cluster bootstrap with n_boot replications.
+    controls(list): List of control variables that are partialled out, optional.
+    fixed_effects(list): List of categorical variables (e.g. campus, cohort) that are absorbed as fixed effects.
+    seed(int): Seed of the wild cluster bootstrap, fixed by default so that the table can be replicated.
+    weights(string): Bootstrap weights, 'rademacher' or 'webb'.
+    restricted(bool): Whether the bootstrap samples are generated under the null.
 
     Returns:
     ---------
@@ -53,22 +64,16 @@ def estimate_RDD_multiple_outcomes(data, outcomes, regressors):
 
     for outcome in outcomes:
         data = data.dropna(subset=[outcome])
-        model = sm.regression.linear_model.OLS(
-            data[outcome], data[regressors], hasconst=True)
-        result = model.fit(cov_type='cluster', cov_kwds={
-                           'groups': data['clustervar']})
-        outputs = [result.params['gpalscutoff'], result.pvalues['gpalscutoff'], result.bse['gpalscutoff'],
-                   result.params['const'], result.pvalues[
-                       'const'], result.bse['const'],
-                   len(data[outcome])]
-        table.loc[outcome] = outputs
+        table.loc[outcome] = _estimate_RDD(data, outcome, regressors, controls, fixed_effects, n_boot, seed,
+                                           weights, restricted)
 
     table = table.round(3)
     
     return table
 
 
-def estimate_RDD_multiple_datasets(dictionary, keys, outcome, regressors):
+def estimate_RDD_multiple_datasets(dictionary, keys, outcome, regressors, n_boot=None, controls=None,
+                                   fixed_effects=None, seed=0, weights='rademacher', restricted=True):
     """ Regression analysis for ONE outcome with standard errors on GPA and with dictionary of MANY dataframes as input.
 
     Args:
@@ -76,6 +81,12 @@ def estimate_RDD_multiple_datasets(dictionary, keys, outcome, regressors):
     dictionary(pd.dict): Dictionary containing datasets ( datasets must contain 'clustervar', 'gpalscutoff', & 'const')
     outcome(string): Name of outcome variable (must correspond to column name in datasets )
     regressors(list): List of all regressors(must correspond to column names in datasets)
+    n_boot(int): If specified, p-values are computed from a wild cluster bootstrap with n_boot replications.
+    controls(list): List of control variables that are partialled out, optional.
+    fixed_effects(list): List of categorical variables (e.g. campus, cohort) that are absorbed as fixed effects.
+    seed(int): Seed of the wild cluster bootstrap, fixed by default so that the table can be replicated.
+    weights(string): Bootstrap weights, 'rademacher' or 'webb'.
+    restricted(bool): Whether the bootstrap samples are generated under the null.
 
     Returns:
     ----------
@@ -92,30 +103,340 @@ def estimate_RDD_multiple_datasets(dictionary, keys, outcome, regressors):
     for key in keys:
         data = dictionary[key]
         data = data.dropna(subset=[outcome])
-        model = sm.regression.linear_model.OLS(
-            data[outcome], data[regressors], hasconst=True)
-        result = model.fit(cov_type='cluster', cov_kwds={
-            'groups': data['clustervar']})
-        outputs = [result.params['gpalscutoff'], result.pvalues['gpalscutoff'], result.bse['gpalscutoff'],
-                   result.params['const'], result.pvalues['const'], result.bse['const'], len(data[outcome])]
-        table.loc[key] = outputs
+        table.loc[key] = _estimate_RDD(data, outcome, regressors, controls, fixed_effects, n_boot, seed, weights,
+                                       restricted)
 
     table = table.round(3)
     return table
 
 
-def create_table1(data):
+def _estimate_RDD(data, outcome, regressors, controls, fixed_effects, n_boot, seed, weights, restricted):
     """
-      Creates Table 1.
+    Computes one row of the RDD tables, with controls and fixed effects partialled out if specified.
     """
-    variables = data[['hsgrade_pct', 'totcredits_year1', 'age_at_entry', 'male', 'english', 
-                      'bpl_north_america','loc_campus1', 'loc_campus2', 'loc_campus3', 'dist_from_cut', 
-                      'probation_year1', 'probation_ever','left_school', 'nextGPA', 'suspended_ever', 
-                      'gradin4', 'gradin5', 'gradin6']]
+    result = covariate_adjusted_ols(data, outcome, regressors, controls, fixed_effects)
+    treat = regressors.index('gpalscutoff')
+    const = regressors.index('const')
+    pvalues = result['pvalues'][0].copy()
+    if n_boot is not None:
+        # Only the two reported coefficients are tested.
+        for idx in (treat, const):
+            pvalues[idx] = wild_cluster_bootstrap(result['X'], result['y'], result['clusters'], idx, n_boot,
+                                                  weights, restricted, seed)['p-value']
 
-    table1 = pd.DataFrame()
-    table1['Mean'] = variables.mean()
-    table1['Standard Deviation'] = variables.std()
+    return [result['params'][0, treat], pvalues[treat], result['bse'][0, treat],
+            result['params'][0, const], pvalues[const], result['bse'][0, const], result['nobs'][0]]
+
+
+def estimate_RDD_local_polynomial(dictionary, keys, outcome, bandwidth, order=1, kernel='uniform'):
+    """ Local polynomial RD analysis for ONE outcome with standard errors clustered on GPA and with dictionary 
+    of MANY dataframes as input. For order=1 and kernel='uniform' the estimates are the ones of 
+    estimate_RDD_multiple_datasets for the sample with abs(dist_from_cut) <= bandwidth.
+
+    Args:
+    ------
+    dictionary(pd.dict): Dictionary containing datasets (datasets must contain 'clustervar' & 'dist_from_cut')
+    keys(list): List of keys of the datasets that should be used.
+    outcome(string): Name of outcome variable (must correspond to column name in datasets)
+    bandwidth(float): Bandwidth around the cutoff.
+    order(int): Order of the polynomial on each side of the cutoff (0, ..., 4).
+    kernel(string): 'uniform', 'triangular' or 'epanechnikov'.
+
+    Returns:
+    ----------
+    table(pd.DataFrame): Dataframe containing the jump at the cutoff ('GPA below cutoff'), the limit from above 
+                         ('Intercept') and their pvalues and standard errors.
+    """
+    table = pd.DataFrame({'GPA below cutoff (1)': [], 'P-Value (1)': [], 'Std.err (1)': [],
+                          'Intercept (0)': [], 'P-Value (0)': [], 'Std.err (0)': [],
+                          'Observations': []})
+
+    table['groups'] = keys
+    table = table.set_index('groups')
+
+    for key in keys:
+        data = dictionary[key].dropna(subset=[outcome])
+        clusters, uniques = pd.factorize(data['clustervar'])
+        result = local_polynomial_rd(data['dist_from_cut'], data[outcome], clusters, len(uniques),
+                                     bandwidth, order, kernel)
+        table.loc[key] = [result['params'][0, 0], result['pvalues'][0, 0], result['bse'][0, 0],
+                          result['params'][0, 1], result['pvalues'][0, 1], result['bse'][0, 1],
+                          result['nobs'][0]]
+
+    table = table.round(3)
+
+    return table
+
+
+def estimate_quantile_RDD_multiple_datasets(dictionary, keys, outcome, bandwidth, quantiles=None, n_boot=200,
+                                            seed=0):
+    """ Quantile RD analysis for ONE outcome with dictionary of MANY dataframes as input. For each dataset the
+    jumps at all quantiles are estimated together, standard errors come from a bootstrap over 'clustervar'.
+
+    Args:
+    ------
+    dictionary(pd.dict): Dictionary containing datasets (datasets must contain 'clustervar' & 'dist_from_cut')
+    keys(list): List of keys of the datasets that should be used.
+    outcome(string): Name of outcome variable (must correspond to column name in datasets)
+    bandwidth(float): Bandwidth around the cutoff.
+    quantiles(list): Quantiles of the outcome, by default 0.05, 0.1, ..., 0.95.
+    n_boot(int): Number of cluster bootstrap replications.
+    seed(int): Seed of the cluster bootstrap, fixed by default so that the table can be replicated.
+
+    Returns:
+    ----------
+    table(pd.DataFrame): Dataframe with one row per dataset and quantile containing the jump of the quantile at
+                         the cutoff ('GPA below cutoff'), the quantile just above the cutoff ('Intercept') and
+                         their pvalues and bootstrap standard errors.
+    """
+    if quantiles is None:
+        quantiles = np.round(np.arange(0.05, 1, 0.05), 2)
+
+    tables = []
+    for key in keys:
+        arrays = prepare_rdd_arrays(dictionary[key], [outcome])
+        window = window_slice(arrays, -bandwidth, bandwidth)
+        result = cluster_bootstrap_quantile_rd(arrays['running'][window], arrays[outcome][window],
+                                               arrays['clusters'][window], quantiles, bandwidth, n_boot, seed)
+        table = pd.DataFrame({'GPA below cutoff (1)': result['params'][:, 0],
+                              'P-Value (1)': result['pvalues'][:, 0],
+                              'Std.err (1)': result['bse'][:, 0],
+                              'Intercept (0)': result['params'][:, 1],
+                              'P-Value (0)': result['pvalues'][:, 1],
+                              'Std.err (0)': result['bse'][:, 1],
+                              'Observations': result['nobs']},
+                             index=pd.MultiIndex.from_product([[key], quantiles], names=['groups', 'quantile']))
+        tables.append(table)
+
+    table = pd.concat(tables).round(3)
+
+    return table
+
+
+def _format_cell_value(value):
+    """
+    Formats the cutoff or cohort of a cell. Whole numbers in float columns (e.g. cohorts) have no decimals.
+    """
+    return '{:g}'.format(value) if isinstance(value, (float, np.floating)) else str(value)
+
+
+def estimate_RDD_multiple_cutoffs(data, outcome, regressors, cutoff_var='cutoff', cohort_var=None, bandwidth=None):
+    """ Regression analysis for ONE outcome with standard errors clustered on GPA, separately at each 
+    campus-specific cutoff (and cohort) and pooled over all cutoffs using the normalized running variable.
+    All cutoffs share one sorted copy of the data and one factorization of the clusters, the cross-products
+    are only summed per cutoff.
+
+    Args:
+    ------
+    data(pd.DataFrame): Dataset containing all data (must contain 'clustervar', 'dist_from_cut' & cutoff_var)
+    outcome(string): Name of outcome variable (must correspond to column name in dataset)
+    regressors(list): List of all regressors (must correspond to column names in dataset)
+    cutoff_var(string): Name of the column containing the cutoff that applies to each student.
+    cohort_var(string): Name of a column (e.g. entry cohort) that further splits each cutoff, optional.
+    bandwidth(float): Only students with abs(dist_from_cut) < bandwidth are used, optional.
+
+    Returns:
+    ---------
+    table(pd.DataFrame): Dataframe containing the coefficient, pvalue and standard error for the dummy 
+                        'GPA below cutoff' and the constant for the pooled sample and for each cutoff.
+    """
+    split_vars = [cutoff_var] if cohort_var is None else [cutoff_var, cohort_var]
+    # Students without a cutoff (or cohort) cannot be assigned to a cell and are dropped from all estimates.
+    data = data.dropna(subset=split_vars)
+    arrays = prepare_rdd_arrays(data, [outcome] + regressors + split_vars)
+    if bandwidth is not None:
+        arrays = subset_arrays(arrays, window_slice(arrays, -bandwidth, bandwidth, closed=False))
+
+    X = np.column_stack([arrays[regressor] for regressor in regressors])
+    y = arrays[outcome].astype(float)
+    cells = pd.DataFrame({var: arrays[var] for var in split_vars})
+    cell_codes = cells.groupby(split_vars, sort=True).ngroup().to_numpy()
+    cell_values = cells.drop_duplicates().sort_values(split_vars)
+
+    labels = ['Pooled']
+    for values in cell_values.itertuples(index=False):
+        label = 'Cutoff ' + _format_cell_value(values[0])
+        if cohort_var is not None:
+            label = label + ', ' + cohort_var + ' ' + _format_cell_value(values[1])
+        labels.append(label)
+
+    pooled = grouped_cluster_ols(X, y, np.zeros(len(y), dtype=np.int64), 1,
+                                 arrays['clusters'], arrays['n_clusters'])
+    by_cutoff = grouped_cluster_ols(X, y, cell_codes, len(cell_values),
+                                    arrays['clusters'], arrays['n_clusters'])
+
+    treat = regressors.index('gpalscutoff')
+    const = regressors.index('const')
+    table = pd.DataFrame(index=pd.Index(labels, name='cutoffs'))
+    for name, idx in [('GPA below cutoff (1)', treat), ('Intercept (0)', const)]:
+        number = name[-3:]
+        table[name] = np.concatenate([pooled['params'][:, idx], by_cutoff['params'][:, idx]])
+        table['P-Value ' + number] = np.concatenate([pooled['pvalues'][:, idx], by_cutoff['pvalues'][:, idx]])
+        table['Std.err ' + number] = np.concatenate([pooled['bse'][:, idx], by_cutoff['bse'][:, idx]])
+    table['Observations'] = np.concatenate([pooled['nobs'], by_cutoff['nobs']])
+
+    table = table.round(3)
+
+    return table
+
+
+def estimate_fuzzy_RDD_multiple_datasets(dictionary, keys, outcomes, regressors, treatment='probation_year1',
+                                         instrument='gpalscutoff'):
+    """ Fuzzy RD (2SLS) analysis for MANY outcomes with standard errors clustered on GPA and with dictionary of 
+    MANY dataframes as input. Being below the cutoff is used as instrument for the treatment. Within each 
+    dataset the first stage and the reduced forms of all outcomes are estimated with one factorization.
+
+    Args:
+    ------
+    dictionary(pd.dict): Dictionary containing datasets (datasets must contain 'clustervar', treatment & 'const')
+    keys(list): List of keys of the datasets that should be used.
+    outcomes(list): List of outcome variables (must correspond to column names in datasets)
+    regressors(list): List of all regressors including the instrument (must correspond to column names in datasets)
+    treatment(string): Name of the treatment variable, e.g. 'probation_year1' or 'probation_ever'.
+    instrument(string): Name of the regressor that is replaced by the treatment in the second stage.
+
+    Returns:
+    ----------
+    table(pd.DataFrame): Dataframe containing the coefficient, pvalue and standard error for the treatment and 
+                         the constant for each outcome, columns are laid out as in estimate_RDD_multiple_datasets.
+    """
+    columns = ['Treatment effect (1)', 'P-Value (1)', 'Std.err (1)',
+               'Intercept (0)', 'P-Value (0)', 'Std.err (0)', 'Observations']
+    table = pd.DataFrame(index=pd.Index(keys, name='groups'),
+                         columns=pd.MultiIndex.from_product([outcomes, columns]), dtype=float)
+
+    treat = regressors.index(instrument)
+    const = regressors.index('const')
+    for key in keys:
+        data = dictionary[key]
+        clusters, uniques = pd.factorize(data['clustervar'])
+        result = cluster_2sls(data[regressors], data[treatment], data[outcomes],
+                              clusters, len(uniques), treat)
+        for idx, outcome in enumerate(outcomes):
+            table.loc[key, outcome] = [result['params'][idx, treat], result['pvalues'][idx, treat],
+                                       result['bse'][idx, treat], result['params'][idx, const],
+                                       result['pvalues'][idx, const], result['bse'][idx, const],
+                                       result['nobs'][idx]]
+
+    table = table.round(3)
+
+    return table
+
+
+def compute_moments(data, variables, by=None):
+    """
+    Computes count, mean and sum of squared deviations from the mean (M2) of many variables, split by group, in
+    one scan of the data. Missing values are skipped for each variable separately. The result of different
+    chunks of a dataset can be combined with merge_moments.
+
+    Args:
+    ------
+        data(pd.DataFrame): Dataset (or chunk of a dataset) containing the variables.
+        variables(list): List of variables.
+        by(string or function): Column that defines the groups or function that returns the group of each row
+                                of data, optional. Without groups, all rows belong to the group 'All'. Rows
+                                with a missing group are skipped, as in pandas' groupby.
+
+    Returns:
+    ---------
+        moments(pd.DataFrame): Dataframe with index (group, variable) and columns 'count', 'mean' and 'm2'.
+    """
+    if by is None:
+        labels = np.repeat('All', len(data))
+    elif callable(by):
+        labels = by(data)
+    else:
+        labels = data[by]
+    codes, groups = pd.factorize(np.asarray(labels))
+    # pd.factorize codes missing groups as -1.
+    grouped = codes >= 0
+    codes = codes[grouped]
+
+    values = data[variables].to_numpy(dtype=float)[grouped]
+    observed = ~np.isnan(values)
+    counts = group_sum(codes, observed.astype(float), len(groups))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = group_sum(codes, np.where(observed, values, 0), len(groups)) / counts
+    deviations = np.where(observed, values - means[codes], 0)
+    m2 = group_sum(codes, deviations ** 2, len(groups))
+
+    index = pd.MultiIndex.from_product([groups, variables], names=['group', 'variable'])
+    return pd.DataFrame({'count': counts.ravel(), 'mean': means.ravel(), 'm2': m2.ravel()}, index=index)
+
+
+def merge_moments(left, right):
+    """
+    Combines the moments of two disjoint parts of a dataset (Chan et al.'s parallel version of Welford's
+    algorithm).
+    """
+    left, right = left.align(right, join='outer', fill_value=0)
+    count = left['count'] + right['count']
+    delta = right['mean'] - left['mean']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = (right['count'] / count).fillna(0)
+        mean = left['mean'] + delta * share
+        m2 = left['m2'] + right['m2'] + (delta ** 2 * left['count'] * share).fillna(0)
+    mean[left['count'] == 0] = right['mean']
+    mean[right['count'] == 0] = left['mean']
+    mean[count == 0] = np.nan
+
+    return pd.DataFrame({'count': count, 'mean': mean, 'm2': m2})
+
+
+def compute_moments_chunked(chunks, variables, by=None, processes=None):
+    """
+    Computes the moments of a dataset that is split into chunks, e.g. pd.read_stata(..., chunksize=10000).
+    Each chunk is scanned once, the moments of all chunks are merged afterwards.
+
+    Args:
+    ------
+        chunks(iterable): Iterable of dataframes.
+        variables(list): List of variables.
+        by(string or function): See compute_moments. Functions must be defined at module level if processes
+                                is specified.
+        processes(int): Number of worker processes, optional. By default chunks are processed one by one.
+
+    Returns:
+    ---------
+        moments(pd.DataFrame): Dataframe with index (group, variable) and columns 'count', 'mean' and 'm2'.
+    """
+    moments = functools.partial(compute_moments, variables=variables, by=by)
+    if processes is None:
+        return functools.reduce(merge_moments, map(moments, chunks))
+
+    with multiprocessing.Pool(processes) as pool:
+        return functools.reduce(merge_moments, pool.imap(moments, chunks))
+
+
+def summarize_moments(moments, ddof=1):
+    """
+    Turns moments into counts, means and standard deviations.
+    """
+    summary = pd.DataFrame(index=moments.index)
+    summary['count'] = moments['count']
+    summary['mean'] = moments['mean']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        summary['std'] = np.sqrt(moments['m2'] / (moments['count'] - ddof))
+
+    return summary
+
+
+def create_table1(data, processes=None):
+    """
+      Creates Table 1. data can also be an iterable of chunks of the dataset.
+    """
+    variables = ['hsgrade_pct', 'totcredits_year1', 'age_at_entry', 'male', 'english', 
+                 'bpl_north_america','loc_campus1', 'loc_campus2', 'loc_campus3', 'dist_from_cut', 
+                 'probation_year1', 'probation_ever','left_school', 'nextGPA', 'suspended_ever', 
+                 'gradin4', 'gradin5', 'gradin6']
+
+    chunks = [data] if isinstance(data, pd.DataFrame) else data
+    summary = summarize_moments(compute_moments_chunked(chunks, variables, processes=processes))
+    summary = summary.reindex(pd.MultiIndex.from_product([['All'], variables]))
+
+    table1 = pd.DataFrame(index=variables)
+    table1['Mean'] = summary['mean'].to_numpy()
+    table1['Standard Deviation'] = summary['std'].to_numpy()
     table1 = table1.astype(float).round(2)
     table1['Description'] = [
                              "High School Grade Percentile", 
@@ -172,28 +493,31 @@ def create_table6(dictionary, keys, regressors):
     return table6
 
 
-def describe_covariates_at_cutoff(data, bandwidth):
+def _cutoff_side(data):
     """
-      Summary table used for validity checks. 
+    Returns for each student whether the first year GPA is below or above the cutoff.
+    """
+    return np.where(data['dist_from_cut'] < 0, 'Below cutoff', 'Above cutoff')
+
+
+def describe_covariates_at_cutoff(data, bandwidth, processes=None):
+    """
+      Summary table used for validity checks. data can also be an iterable of chunks of the dataset.
     """
     variables = ['hsgrade_pct', 'totcredits_year1', 'age_at_entry', 'male', 'english', 
                  'bpl_north_america','loc_campus1', 'loc_campus2', 'loc_campus3']
 
-    treat = pd.DataFrame()
-    untreat = pd.DataFrame()
-
-    sample = data[abs(data['dist_from_cut']) < bandwidth]
-    sample_treat = sample[sample['dist_from_cut'] < 0]
-    sample_untreat = sample[sample['dist_from_cut'] >= 0]
+    chunks = [data] if isinstance(data, pd.DataFrame) else data
+    samples = (chunk[abs(chunk['dist_from_cut']) < bandwidth] for chunk in chunks)
+    summary = summarize_moments(compute_moments_chunked(samples, variables, _cutoff_side, processes))
 
-    # treated sample.
-    treat['Mean'] = sample_treat[variables].mean()
-    treat['Std.'] = sample_treat[variables].std()
-    # untreated sample.
-    untreat['Mean'] = sample_untreat[variables].mean()
-    untreat['Std.'] = sample_untreat[variables].std()
+    # treated and untreated sample.
+    table = pd.DataFrame(index=variables)
+    for side in ['Below cutoff', 'Above cutoff']:
+        side_summary = summary.reindex(pd.MultiIndex.from_product([[side], variables]))
+        table[side + ' Mean'] = side_summary['mean'].to_numpy()
+        table[side + ' Std.'] = side_summary['std'].to_numpy()
 
-    table = pd.concat([treat, untreat], axis=1)
     table.columns = pd.MultiIndex.from_product([['Below cutoff', 'Above cutoff'],
                                                 ['Mean', 'Std.']])
     table = table.astype(float).round(2)